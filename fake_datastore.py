@@ -0,0 +1,252 @@
+# Copyright 2017 Scraper Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An in-process stand-in for the parts of cloud datastore used by sync.py.
+
+The datastore emulator serves whatever it is given as fast as it can, which
+makes it useless for measuring how sync.py behaves against the real service.
+FakeDatastore instead serves a synthetic fleet of dropboxrsyncaddress entities
+one page at a time, with a configurable latency per page, random jitter on
+that latency, and a rate of injected transient failures.  A configurable rate
+of writes keeps the fleet data changing, as the scrapers would.
+
+Its client method has the signature of datastore.Client, so it can be used as
+the client_factory of a sync.DatastorePool.
+"""
+
+import collections
+import datetime
+import random
+import threading
+import time
+
+# pylint: disable=no-name-in-module
+from google.api_core import exceptions as api_exceptions
+# pylint: enable=no-name-in-module
+
+# The (experiment, rsync_module) pairs that synthetic endpoints cycle through.
+EXPERIMENTS = [('ndt.iupui', 'ndt'),
+               ('utility.mlab', 'switch'),
+               ('utility.mlab', 'utilization'),
+               ('sidestream.web100', 'sidestream'),
+               ('paris-traceroute.mlab', 'paris-traceroute')]
+
+# The number of machines at each synthetic site.
+MACHINES_PER_SITE = 4
+
+# The kind of entity this fake holds.  Queries for other kinds find nothing.
+KIND = 'dropboxrsyncaddress'
+
+# A datatype standing in for datastore.Key, of which only the name is used.
+FakeKey = collections.namedtuple('FakeKey', ['name'])
+
+
+class FakeEntity(dict):
+    """A dictionary with a key, standing in for datastore.Entity."""
+
+    def __init__(self, name, properties):
+        dict.__init__(self, properties)
+        self.key = FakeKey(name)
+
+
+def xdatetime(seconds):
+    """Format seconds since the epoch as the inverse of sync.parse_xdatetime."""
+    return 'x' + datetime.datetime.utcfromtimestamp(seconds).strftime(
+        '%Y-%m-%d %H:%M:%S')
+
+
+def site_name(number):
+    """Returns a site name, like 'aab07', that is unique to the number."""
+    letters = ''.join(chr(ord('a') + (number // 100 // 26 ** place) % 26)
+                      for place in (2, 1, 0))
+    return '%s%02d' % (letters, number % 100)
+
+
+def rsync_url(number):
+    """Returns an rsync url that is unique to the number."""
+    experiment, rsync_module = EXPERIMENTS[number % len(EXPERIMENTS)]
+    machine = number // len(EXPERIMENTS)
+    return 'rsync://%s.mlab%d.%s.measurement-lab.org:7999/%s' % (
+        experiment, 1 + machine % MACHINES_PER_SITE,
+        site_name(machine // MACHINES_PER_SITE), rsync_module)
+
+
+class FakeDatastore(object):
+    """Synthetic fleet data, served with injected latency and failures.
+
+    Args:
+      entities: the number of rsync endpoints in the fleet
+      page_size: the number of entities returned per simulated round trip
+      page_latency: the mean time, in seconds, taken by each round trip
+      latency_jitter: the latency varies uniformly by up to this much
+      error_rate: the probability that a round trip fails with a transient
+          error, possibly after some pages of a query have been served
+      writes_per_second: how often, on average, an endpoint's status changes
+      never_collected_rate: the fraction of endpoints that start out without
+          a successful collection
+      seed: the seed for every random choice, for reproducible runs
+    """
+
+    def __init__(self, entities=1000, page_size=300, page_latency=0.05,
+                 latency_jitter=0.02, error_rate=0.0, writes_per_second=1.0,
+                 never_collected_rate=0.02, seed=0):
+        self.page_size = page_size
+        self.page_latency = page_latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.writes_per_second = writes_per_second
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # Counts of what has happened, for reporting by benchmarks.
+        self.stats = collections.Counter()
+        now = time.time()
+        self._last_write = now
+        self._entities = []
+        for number in range(entities):
+            attempt = now - self._random.uniform(0, 60 * 60)
+            if self._random.random() < never_collected_rate:
+                success = None
+            else:
+                success = attempt - self._random.expovariate(1.0 / (60 * 60))
+            self._entities.append(
+                FakeEntity(rsync_url(number), self._status(attempt, success)))
+
+    @staticmethod
+    def _status(attempt, success):
+        """Returns the properties of an entity, given its collection times."""
+        if success is None:
+            return {'lastsuccessfulcollection': '',
+                    'errorsincelastsuccessful': 'Scrape and upload failed: 1',
+                    'lastcollectionattempt': xdatetime(attempt),
+                    'maxrawfilemtimearchived': ''}
+        return {'lastsuccessfulcollection': xdatetime(success),
+                'errorsincelastsuccessful': '',
+                'lastcollectionattempt': xdatetime(attempt),
+                'maxrawfilemtimearchived': int(success) - 10 * 60}
+
+    def _apply_writes(self, now):
+        """Simulate the scraper writes that would have happened by now.
+
+        Must be called with the lock held.
+        """
+        if self.writes_per_second <= 0 or not self._entities:
+            self._last_write = now
+            return
+        writes = int((now - self._last_write) * self.writes_per_second)
+        self._last_write += writes / float(self.writes_per_second)
+        for _ in range(writes):
+            position = self._random.randrange(len(self._entities))
+            entity = self._entities[position]
+            properties = dict(entity)
+            if self._random.random() < 0.9:
+                properties.update(self._status(now, now))
+            else:
+                properties['lastcollectionattempt'] = xdatetime(now)
+                properties['errorsincelastsuccessful'] = (
+                    'Scrape and upload failed: 1')
+            # Writes replace entities, so that results already handed out
+            # never change.
+            self._entities[position] = FakeEntity(entity.key.name, properties)
+            self.stats['writes'] += 1
+
+    def _round_trip(self, timeout):
+        """Wait for one simulated round trip, which may fail.
+
+        The random choices and the stats are updated under the lock, so that
+        concurrent queries lose no counts and draw from one seeded sequence,
+        but the waiting happens outside it.
+        """
+        with self._lock:
+            latency = max(0, self.page_latency +
+                          self._random.uniform(-self.latency_jitter,
+                                               self.latency_jitter))
+            fails = self._random.random() < self.error_rate
+            self.stats['round_trips'] += 1
+            if timeout is not None and latency > timeout:
+                self.stats['deadlines_exceeded'] += 1
+            elif fails:
+                self.stats['errors'] += 1
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+            raise api_exceptions.DeadlineExceeded('Injected: took too long')
+        time.sleep(latency)
+        if fails:
+            raise api_exceptions.ServiceUnavailable('Injected: unavailable')
+
+    def run_query(self, query, limit=None, timeout=None):
+        """Yield the results of the query, one page per round trip."""
+        with self._lock:
+            self._apply_writes(time.time())
+            results = list(self._entities) if query.kind == KIND else []
+        for ordering in reversed(query.order):
+            prop = ordering.lstrip('-')
+            # The sort finishes before prop changes.
+            # pylint: disable=cell-var-from-loop
+            results.sort(key=lambda entity: entity.get(prop, ''),
+                         reverse=ordering.startswith('-'))
+            # pylint: enable=cell-var-from-loop
+        if limit is not None:
+            results = results[:limit]
+        if query.projection:
+            results = [FakeEntity(entity.key.name,
+                                  dict((prop, entity[prop])
+                                       for prop in query.projection
+                                       if prop in entity))
+                       for entity in results]
+        start = 0
+        while True:
+            self._round_trip(timeout)
+            for entity in results[start:start + self.page_size]:
+                yield entity
+            start += self.page_size
+            if start >= len(results):
+                return
+
+    def client(self, namespace=None, **_kwargs):
+        """Returns a client, with the signature of datastore.Client.
+
+        Every namespace holds the same fleet.
+        """
+        return FakeClient(self, namespace)
+
+
+class FakeClient(object):
+    """Stands in for datastore.Client."""
+
+    def __init__(self, store, namespace):
+        self.store = store
+        self.namespace = namespace
+
+    def query(self, kind=None, projection=(), order=()):
+        """Returns a query for entities of the kind."""
+        return FakeQuery(self.store, kind, list(projection), list(order))
+
+
+class FakeQuery(object):
+    """Stands in for datastore.query.Query."""
+
+    def __init__(self, store, kind, projection, order):
+        self.store = store
+        self.kind = kind
+        self.projection = projection
+        self.order = order
+
+    # pylint: disable=unused-argument
+    def fetch(self, limit=None, retry=None, timeout=None):
+        """Returns an iterator over the results, which fetches page by page.
+
+        Retries are never made here, whatever the retry argument says.
+        """
+        return self.store.run_query(self, limit=limit, timeout=timeout)
+    # pylint: enable=unused-argument
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# Copyright 2017 Scraper Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# No docstrings required for tests.
+# Tests need to be methods of classes to aid in organization of tests. Using
+#   the 'self' variable is not required.
+# "Too many public methods" here means "many tests", which is good not bad.
+# This code is in a subdirectory, but is intended to stand alone, so it uses
+#   what look like relative imports to the linter
+# pylint: disable=missing-docstring, no-self-use, too-many-public-methods
+# pylint: disable=relative-import
+
+import datetime
+import threading
+import unittest
+
+import freezegun
+import mock
+
+# pylint: disable=no-name-in-module
+from google.api_core import exceptions as api_exceptions
+# pylint: enable=no-name-in-module
+
+import fake_datastore
+import sync
+
+
+class TestFakeDatastore(unittest.TestCase):
+
+    def setUp(self):
+        sleep_patcher = mock.patch.object(fake_datastore.time, 'sleep')
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def fetch(self, store, **kwargs):
+        query = store.client(namespace='scraper').query(
+            kind='dropboxrsyncaddress')
+        return list(query.fetch(**kwargs))
+
+    def test_rsync_urls(self):
+        urls = [fake_datastore.rsync_url(number) for number in range(5000)]
+        self.assertEqual(len(set(urls)), len(urls))
+        for url in urls:
+            self.assertIsNotNone(sync.deconstruct_rsync_url(url), url)
+
+    def test_entities_are_valid_fleet_data(self):
+        store = fake_datastore.FakeDatastore(entities=100)
+        data = [sync.status_to_dict(x) for x in self.fetch(store)]
+        self.assertEqual(len(data), 100)
+        index = sync.FleetIndex(data)
+        self.assertEqual(len(index.timestamps) + len(index.never_collected),
+                         100)
+        self.assertGreater(len(index.timestamps), 90)
+        self.assertEqual(len(index.select({'site': ['aaa00']})),
+                         len(fake_datastore.EXPERIMENTS) *
+                         fake_datastore.MACHINES_PER_SITE)
+
+    def test_same_seed_same_data(self):
+        with freezegun.freeze_time('2017-03-28'):
+            first = self.fetch(fake_datastore.FakeDatastore(entities=50))
+            second = self.fetch(fake_datastore.FakeDatastore(entities=50))
+        self.assertEqual(first, second)
+
+    def test_pages_and_latency(self):
+        store = fake_datastore.FakeDatastore(entities=25, page_size=10,
+                                             page_latency=0.1,
+                                             latency_jitter=0.05)
+        self.assertEqual(len(self.fetch(store)), 25)
+        self.assertEqual(self.sleep.call_count, 3)
+        for call in self.sleep.call_args_list:
+            self.assertTrue(0.05 <= call[0][0] <= 0.15)
+        self.assertEqual(store.stats['round_trips'], 3)
+
+    def test_empty_results_take_a_round_trip(self):
+        store = fake_datastore.FakeDatastore(entities=25)
+        self.assertEqual(list(store.client().query(kind='other').fetch()), [])
+        self.assertEqual(self.sleep.call_count, 1)
+
+    def test_deadline(self):
+        store = fake_datastore.FakeDatastore(entities=10, page_latency=1,
+                                             latency_jitter=0)
+        with self.assertRaises(api_exceptions.DeadlineExceeded):
+            self.fetch(store, timeout=0.5)
+        self.sleep.assert_called_once_with(0.5)
+        self.assertEqual(len(self.fetch(store, timeout=2)), 10)
+
+    def test_errors_after_partial_results(self):
+        store = fake_datastore.FakeDatastore(entities=20, page_size=10)
+        results = store.client().query(kind='dropboxrsyncaddress').fetch()
+        first_page = [next(results) for _ in range(10)]
+        store.error_rate = 1
+        with self.assertRaises(api_exceptions.ServiceUnavailable):
+            next(results)
+        self.assertEqual(len(first_page), 10)
+        self.assertEqual(store.stats['errors'], 1)
+
+    def test_concurrent_queries_count_every_round_trip(self):
+        store = fake_datastore.FakeDatastore(entities=50, page_size=10,
+                                             error_rate=0.5)
+        failures = []
+
+        def fetch_until_done():
+            for _ in range(20):
+                try:
+                    self.fetch(store)
+                except api_exceptions.ServiceUnavailable:
+                    failures.append(1)
+
+        threads = [threading.Thread(target=fetch_until_done)
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(store.stats['errors'], len(failures))
+        self.assertEqual(self.sleep.call_count, store.stats['round_trips'])
+
+    def test_order_projection_and_limit(self):
+        store = fake_datastore.FakeDatastore(entities=30)
+        query = store.client().query(kind='dropboxrsyncaddress',
+                                     projection=['lastcollectionattempt'],
+                                     order=['-lastcollectionattempt'])
+        latest = list(query.fetch(limit=1))
+        self.assertEqual(len(latest), 1)
+        self.assertEqual(latest[0].keys(), ['lastcollectionattempt'])
+        self.assertEqual(
+            latest[0]['lastcollectionattempt'],
+            max(x['lastcollectionattempt'] for x in self.fetch(store)))
+
+    def test_writes(self):
+        with freezegun.freeze_time('2017-03-28') as frozen_time:
+            store = fake_datastore.FakeDatastore(entities=30,
+                                                 writes_per_second=2)
+            before = self.fetch(store)
+            frozen_time.tick(datetime.timedelta(seconds=10))
+            after = self.fetch(store)
+        self.assertEqual(store.stats['writes'], 20)
+        self.assertNotEqual(before, after)
+        self.assertEqual(set(x.key.name for x in before),
+                         set(x.key.name for x in after))
+        self.assertIn('x2017-03-28 00:00:10',
+                      [x['lastcollectionattempt'] for x in after])
+
+    def test_datastore_pool_with_fake(self):
+        store = fake_datastore.FakeDatastore(entities=100, page_size=10,
+                                             error_rate=0.2, seed=1)
+        pool = sync.DatastorePool(client_factory=store.client)
+        with mock.patch.object(sync.time, 'sleep'):
+            entities = pool.fetch_all('scraper', 'dropboxrsyncaddress')
+        self.assertEqual(len(entities), 100)
+        self.assertGreater(store.stats['errors'], 0)
+
+    def test_datastore_pool_probe_with_fake(self):
+        with freezegun.freeze_time('2017-03-28') as frozen_time:
+            store = fake_datastore.FakeDatastore(entities=100,
+                                                 writes_per_second=1)
+            pool = sync.DatastorePool(client_factory=store.client)
+            probe = pool.probe('scraper', 'dropboxrsyncaddress')
+            self.assertEqual(pool.probe('scraper', 'dropboxrsyncaddress'),
+                             probe)
+            frozen_time.tick(datetime.timedelta(seconds=5))
+            self.assertNotEqual(pool.probe('scraper', 'dropboxrsyncaddress'),
+                                probe)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()
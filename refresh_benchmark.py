@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# Copyright 2017 Scraper Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how sync.py refreshes and queries fleet data from a fake datastore.
+
+The fleet data comes from a fake_datastore.FakeDatastore, so the size of the
+fleet, the latency and failure rate of datastore, and the rate at which the
+scrapers write can all be set, and runs with the same arguments see the same
+data.  Each refresh cycle expires the cache of get_fleet_data, waits, and then
+reloads and re-indexes the fleet data, exactly as a request would after the
+cache timed out.  The time taken by a staleness query against the final
+snapshot is measured too.
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+import fake_datastore
+import sync
+
+
+def parse_args(argv):
+    """Parses the command-line arguments.
+
+    Args:
+        argv: the list of arguments, minus the name of the binary
+
+    Returns:
+        A dictionary-like object containing the results of the parse.
+    """
+    parser = argparse.ArgumentParser(
+        description='Measure fleet data refreshes against a fake datastore')
+    parser.add_argument('--cycles', metavar='N', type=int, default=20,
+                        help='The number of refreshes to measure.')
+    parser.add_argument('--interval', metavar='SECONDS', type=float,
+                        default=0.5,
+                        help='The time between refreshes.  In production it '
+                        'is the 30 second cache timeout of get_fleet_data.')
+    parser.add_argument('--entities', metavar='N', type=int, default=5000,
+                        help='The number of rsync endpoints in the fleet.')
+    parser.add_argument('--page_size', metavar='N', type=int, default=300,
+                        help='The number of entities per round trip.')
+    parser.add_argument('--page_latency', metavar='SECONDS', type=float,
+                        default=0.02,
+                        help='The mean time taken by each round trip.')
+    parser.add_argument('--latency_jitter', metavar='SECONDS', type=float,
+                        default=0.01,
+                        help='The latency varies uniformly by up to this much.')
+    parser.add_argument('--error_rate', metavar='FRACTION', type=float,
+                        default=0.0,
+                        help='The fraction of round trips that fail.')
+    parser.add_argument('--writes_per_second', metavar='N', type=float,
+                        default=2.0,
+                        help='How often the status of an endpoint changes.')
+    parser.add_argument('--change_probe_property', metavar='PROPERTY',
+                        type=str, default='lastcollectionattempt',
+                        help='As for sync.py.  Empty disables the probe.')
+    parser.add_argument('--stale_after', metavar='DURATION', type=str,
+                        default='2h',
+                        help='The threshold of the measured staleness query.')
+    parser.add_argument('--seed', metavar='N', type=int, default=0,
+                        help='The seed for the fake fleet data.')
+    return parser.parse_args(argv)
+
+
+def percentile(values, fraction):
+    """Returns the value at the given fraction of the sorted values."""
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def main(argv):
+    """Run the refresh cycles and print a summary of them."""
+    args = parse_args(argv[1:])
+    logging.basicConfig(level=logging.ERROR)
+    store = fake_datastore.FakeDatastore(
+        entities=args.entities, page_size=args.page_size,
+        page_latency=args.page_latency, latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate, writes_per_second=args.writes_per_second,
+        seed=args.seed)
+    sync.DATASTORE_POOL.client_factory = store.client
+    sync.DATASTORE_POOL.change_property = args.change_probe_property
+    namespace = 'benchmark'
+
+    start = time.time()
+    index = sync.get_fleet_index(namespace)
+    first_load = time.time() - start
+
+    refresh_times = []
+    rebuilt = 0
+    for _ in range(args.cycles):
+        time.sleep(args.interval)
+        sync.get_fleet_data.clear_cache()
+        start = time.time()
+        new_index = sync.get_fleet_index(namespace)
+        refresh_times.append(time.time() - start)
+        if new_index is not index:
+            rebuilt += 1
+        index = new_index
+
+    stale_after = sync.parse_duration(args.stale_after)
+    query_times = []
+    for _ in range(100):
+        start = time.time()
+        stale = index.select({}, stale_after=stale_after)
+        query_times.append(time.time() - start)
+
+    print 'entities: %d' % args.entities
+    print 'first load seconds: %.3f' % first_load
+    print 'refreshes: %d, full fetches: %d, skipped: %d' % (
+        args.cycles, rebuilt, args.cycles - rebuilt)
+    print 'refresh seconds: median %.4f, p90 %.4f, max %.4f' % (
+        percentile(refresh_times, 0.5), percentile(refresh_times, 0.9),
+        max(refresh_times))
+    print 'simulated writes: %d, round trips: %d, injected failures: %d' % (
+        store.stats['writes'], store.stats['round_trips'],
+        store.stats['errors'] + store.stats['deadlines_exceeded'])
+    print 'stale_after=%s query: %d endpoints, median %.6f seconds' % (
+        args.stale_after, len(stale), percentile(query_times, 0.5))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main(sys.argv)
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# Copyright 2017 Scraper Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how long it takes sync.py to start up.
+
+Every measurement happens in a fresh python interpreter, so that nothing is
+already imported or cached.  Three times are reported: the time to import sync,
+the time for the first use of the lazily-imported cloud datastore library, and
+the time from starting sync.py until /healthz answers.  sync.py is started with
+the fake datastore backend, slowed down by --page_latency, so the last time
+shows whether loading the fleet data still holds up the webserver.
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib2
+
+# Prints the time to import sync, and then the time to import the datastore
+# library through it.
+TIMING_CODE = '''
+import time
+start = time.time()
+import sync
+imported = time.time()
+sync.datastore.Client
+print('%f %f' % (imported - start, time.time() - imported))
+'''
+
+
+def parse_args(argv):
+    """Parses the command-line arguments.
+
+    Args:
+        argv: the list of arguments, minus the name of the binary
+
+    Returns:
+        A dictionary-like object containing the results of the parse.
+    """
+    parser = argparse.ArgumentParser(
+        description='Measure the startup time of sync.py')
+    parser.add_argument(
+        '--runs',
+        metavar='N',
+        type=int,
+        default=10,
+        help='The number of fresh interpreters to measure.')
+    parser.add_argument(
+        '--page_latency',
+        metavar='SECONDS',
+        type=float,
+        default=0.5,
+        help='The latency of each page of fake fleet data.')
+    return parser.parse_args(argv)
+
+
+def median(values):
+    """Returns the median of a non-empty list of numbers."""
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def measure_once():
+    """Returns the import and datastore import times of a fresh interpreter."""
+    output = subprocess.check_output(
+        [sys.executable, '-c', TIMING_CODE],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    import_time, datastore_time = output.split()
+    return float(import_time), float(datastore_time)
+
+
+def unused_port():
+    """Returns a port that nothing was listening on a moment ago."""
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def measure_healthz(page_latency, timeout=60):
+    """Returns the time from starting sync.py until /healthz answers."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    webserver_port = unused_port()
+    start = time.time()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(directory, 'sync.py'),
+         '--datastore_namespace=benchmark', '--fleet_backend=fake',
+         '--fake_page_latency=%f' % page_latency, '--log_level=ERROR',
+         '--prometheus_port=%d' % unused_port(),
+         '--webserver_port=%d' % webserver_port],
+        cwd=directory, stderr=open(os.devnull, 'w'))
+    try:
+        while time.time() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError('sync.py exited with status %d' %
+                                   process.returncode)
+            try:
+                urllib2.urlopen(
+                    'http://localhost:%d/healthz' % webserver_port).read()
+                return time.time() - start
+            except (urllib2.URLError, socket.error):
+                time.sleep(0.01)
+        raise RuntimeError('/healthz did not answer within %d seconds' %
+                           timeout)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def main(argv):
+    """Run the measurements and print a summary of them."""
+    args = parse_args(argv[1:])
+    times = [measure_once() for _ in range(args.runs)]
+    print 'runs: %d' % args.runs
+    print 'import sync, median seconds: %.3f' % median(
+        [import_time for import_time, _ in times])
+    print 'first use of datastore, median seconds: %.3f' % median(
+        [datastore_time for _, datastore_time in times])
+    print 'start until /healthz answers, median seconds: %.3f' % median(
+        [measure_healthz(args.page_latency) for _ in range(args.runs)])
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main(sys.argv)
@@ -22,17 +22,28 @@ The new scraper has its source of truth in a key-value store (Google Cloud
 Datastore), and this program has the job of presenting that truth to all who
 request it.  The root url will present a table showing the status of every rsync
 endpoint, and the url /json?rsync_filter=substr will provide the status, in json
-form, of all rsync endpoints that contain substr as a substring.
+form, of all rsync endpoints that contain substr as a substring.  The same url
+also accepts experiment, machine, site, rsync_module, stale_after, and
+fresh_within arguments to ask more structured questions of the fleet.
 """
 
 import argparse
+import atexit
 import BaseHTTPServer
+import bisect
 import collections
 import datetime
+import gc
+import importlib
 import logging
 import httplib
 import json
+import os
+import pkgutil
+import Queue
+import random
 import re
+import resource
 import SocketServer
 import ssl
 import sys
@@ -42,13 +53,41 @@ import time
 import traceback
 import urlparse
 
-import dateutil.parser
 import prometheus_client
 import prometheus_client.core
 
-# pylint: disable=no-name-in-module
-from google.cloud import datastore
-# pylint: enable=no-name-in-module
+# The time this program started, for measuring how long startup takes.
+PROCESS_START_TIME = time.time()
+
+
+class LazyModule(object):
+    """A module that is only imported when one of its attributes is first used.
+
+    The cloud datastore library pulls in grpc and protobuf, and importing it
+    used to be most of the startup time of this program.  Importing modules
+    like that lazily lets the webserver start answering health checks while
+    the imports happen as part of loading the first fleet data.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+api_exceptions = LazyModule('google.api_core.exceptions')
+api_retry = LazyModule('google.api_core.retry')
+datastore = LazyModule('google.cloud.datastore')
+dateutil_parser = LazyModule('dateutil.parser')
+fake_datastore = LazyModule('fake_datastore')
+msgpack = LazyModule('msgpack')
+
+# msgpack is only needed to serve the msgpack response format.
+HAVE_MSGPACK = pkgutil.find_loader('msgpack') is not None
 
 # The monitoring variables exported by the prometheus_client
 # The prometheus_client libraries confuse the linter.
@@ -60,18 +99,53 @@ REQUEST_TIMES_JSON = REQUEST_TIMES.labels(message='json')
 REQUEST_TIMES_ROOT_URL = REQUEST_TIMES.labels(message='root_url')
 REQUEST_TIMES_COLLECT = REQUEST_TIMES.labels(message='collect')
 REQUEST_TIMES_ERROR = REQUEST_TIMES.labels(message='error')
+REQUEST_TIMES_HEALTH = REQUEST_TIMES.labels(message='health')
 
 # pylint: disable=no-value-for-parameter
 DATASTORE_TIMES = prometheus_client.Histogram(
     'datastore_time_seconds',
     'Running time of datastore requests')
+DATASTORE_PROBE_TIMES = prometheus_client.Histogram(
+    'datastore_probe_time_seconds',
+    'Running time of datastore change-detection probes')
+DATASTORE_RETRIES = prometheus_client.Counter(
+    'datastore_retries',
+    'Number of datastore queries retried after a transient error')
+DATASTORE_RETRY_SECONDS = prometheus_client.Counter(
+    'datastore_retry_seconds',
+    'Time spent on failed datastore queries and waiting to retry them')
 # pylint: enable=no-value-for-parameter
+DATASTORE_CLIENTS = prometheus_client.Counter(
+    'datastore_clients',
+    'Number of times a datastore client was needed',
+    ['outcome'])  # created or reused
+DATASTORE_CLIENTS_CREATED = DATASTORE_CLIENTS.labels(outcome='created')
+DATASTORE_CLIENTS_REUSED = DATASTORE_CLIENTS.labels(outcome='reused')
+FLEET_REFRESHES = prometheus_client.Counter(
+    'fleet_refreshes',
+    'Number of times the fleet data was due to be refreshed',
+    ['outcome'])  # fetched or skipped
+FLEET_REFRESHES_FETCHED = FLEET_REFRESHES.labels(outcome='fetched')
+FLEET_REFRESHES_SKIPPED = FLEET_REFRESHES.labels(outcome='skipped')
+LOG_RECORDS_DROPPED = prometheus_client.Counter(
+    'log_records_dropped',
+    'Number of log records dropped because the log queue was full')
+LOG_RECORDS_SUPPRESSED = prometheus_client.Counter(
+    'log_records_suppressed',
+    'Number of repeated warnings and errors that were not logged')
+STARTUP_SECONDS = prometheus_client.Gauge(
+    'startup_seconds',
+    'Time from process start until the first fleet data was ready to serve')
 
 
 class SyncException(Exception):
     """The exceptions this system raises."""
 
 
+# The kinds of metrics PrometheusDatastoreCollector can export.
+METRICS_MODES = ('endpoint', 'aggregate', 'both')
+
+
 def parse_args(argv):
     """Parses the command-line arguments.
 
@@ -101,6 +175,119 @@ def parse_args(argv):
         type=int,
         default=80,
         help='The port on which a summary of the fleet status is exported.')
+    parser.add_argument(
+        '--fleet_backend',
+        choices=['datastore', 'fake'],
+        default='datastore',
+        help='Where to read the fleet data from.  The fake backend serves '
+        'synthetic data from memory, with the latency and failures set by the '
+        '--fake_* flags, for benchmarking without cloud datastore.')
+    parser.add_argument(
+        '--fake_entities',
+        metavar='N',
+        type=int,
+        default=1000,
+        help='The number of rsync endpoints in the fake fleet.')
+    parser.add_argument(
+        '--fake_page_size',
+        metavar='N',
+        type=int,
+        default=300,
+        help='The number of fake entities returned per round trip.')
+    parser.add_argument(
+        '--fake_page_latency',
+        metavar='SECONDS',
+        type=float,
+        default=0.05,
+        help='The mean time taken by each round trip to the fake backend.')
+    parser.add_argument(
+        '--fake_latency_jitter',
+        metavar='SECONDS',
+        type=float,
+        default=0.02,
+        help='The fake latency varies uniformly by up to this much.')
+    parser.add_argument(
+        '--fake_error_rate',
+        metavar='FRACTION',
+        type=float,
+        default=0.0,
+        help='The fraction of round trips to the fake backend that fail.')
+    parser.add_argument(
+        '--fake_writes_per_second',
+        metavar='N',
+        type=float,
+        default=1.0,
+        help='How often the status of a fake endpoint changes.')
+    parser.add_argument(
+        '--datastore_deadline',
+        metavar='SECONDS',
+        type=float,
+        default=30.0,
+        help='The deadline for each call to cloud datastore.')
+    parser.add_argument(
+        '--datastore_retry_budget',
+        metavar='SECONDS',
+        type=float,
+        default=60.0,
+        help='The maximum time to spend retrying a cloud datastore query that '
+        'failed with a transient error.')
+    parser.add_argument(
+        '--change_probe_property',
+        metavar='PROPERTY',
+        type=str,
+        default='lastcollectionattempt',
+        help='The property that every write to the fleet data updates.  '
+        'Before each refresh, the entity with the largest value of it is '
+        'fetched, and if that has not changed the refresh is skipped.  Set it '
+        'to the empty string to always refresh.')
+    parser.add_argument(
+        '--max_snapshot_age',
+        metavar='SECONDS',
+        type=float,
+        default=120.0,
+        help='The longest time to keep the fleet data without a full refresh, '
+        'even if the change probe has detected no change.  The probe misses '
+        'writes that leave the largest value of --change_probe_property as it '
+        'was, such as a second write within the same minute, so this bounds '
+        'how stale those can leave the data.')
+    parser.add_argument(
+        '--log_level',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        default='INFO',
+        help='The minimum level of the messages to log.')
+    parser.add_argument(
+        '--log_queue_size',
+        metavar='RECORDS',
+        type=int,
+        default=10000,
+        help='The number of log records that may wait to be written.  When '
+        'the queue is full, new records are dropped instead of waiting.')
+    parser.add_argument(
+        '--access_log_sample_rate',
+        metavar='FRACTION',
+        type=float,
+        default=1.0,
+        help='The fraction of webserver requests to log.')
+    parser.add_argument(
+        '--repeated_log_interval',
+        metavar='SECONDS',
+        type=float,
+        default=60.0,
+        help='Warnings and errors logged from the same line of code are logged '
+        'at most once per this many seconds.')
+    parser.add_argument(
+        '--enable_debug_endpoints',
+        action='store_true',
+        help='Serve CPU profiles, memory statistics, and cache sizes under '
+        '/debug/ on the monitoring port.  These expose the internals of the '
+        'running process, so only enable them where that port is private.')
+    parser.add_argument(
+        '--metrics_mode',
+        choices=METRICS_MODES,
+        default='endpoint',
+        help='Whether to export metrics for every rsync endpoint, aggregated '
+        'metrics per site and experiment, or both.  Aggregated metrics keep '
+        'the number of time series small enough for large fleets.')
     return parser.parse_args(argv)
 
 
@@ -158,41 +345,272 @@ def timed_locking_cache(**kwargs):
         # Add a clear_cache method to the returned function object to aid in
         # testing.  Code not in a *_test.py file should not use this method.
         cached_func.clear_cache = cache.clear
+        # Add a cache_size method to report the number of cached results.
+        cached_func.cache_size = lambda: len(cache)
         return cached_func
     return cacher
 
 
+def no_library_retries():
+    """Returns a retry policy for the datastore client that never retries."""
+    return api_retry.Retry(predicate=lambda _: False)
+
+
+def transient_datastore_errors():
+    """Returns the types of errors from cloud datastore worth retrying."""
+    return (api_exceptions.DeadlineExceeded,
+            api_exceptions.InternalServerError,
+            api_exceptions.ServiceUnavailable,
+            api_exceptions.TooManyRequests)
+
+
+class DatastorePool(object):
+    """Long-lived cloud datastore clients, with deadlines and retries.
+
+    Creating a datastore client loads credentials and sets up its connections,
+    so one client is created per namespace and reused for the life of the
+    process, which lets it keep its connections open between queries.  Every
+    call to datastore has a deadline, and a query that fails with a transient
+    error is retried with exponential backoff until the retry budget is spent.
+    The retries of the client library itself are disabled, so that the retry
+    budget here is the only one.
+
+    Before refreshing a whole kind, a cheap probe can fetch only the entity
+    with the largest value of change_property, which every writer updates.
+    The full refresh may be skipped if that entity and value have not changed.
+
+    Clients are made by client_factory, which defaults to datastore.Client.
+    Any callable with the same signature can be used instead, such as the
+    client method of a fake_datastore.FakeDatastore.
+    """
+
+    def __init__(self, deadline=30, retry_budget=60, initial_backoff=0.5,
+                 max_backoff=8, change_property='lastcollectionattempt',
+                 max_snapshot_age=120, client_factory=None):
+        self.client_factory = client_factory
+        self.deadline = deadline
+        self.retry_budget = retry_budget
+        self.change_property = change_property
+        self.max_snapshot_age = max_snapshot_age
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def client(self, namespace):
+        """Returns the datastore client for the namespace."""
+        with self._lock:
+            if namespace in self._clients:
+                DATASTORE_CLIENTS_REUSED.inc()
+            else:
+                client_factory = self.client_factory or datastore.Client
+                self._clients[namespace] = client_factory(namespace=namespace)
+                DATASTORE_CLIENTS_CREATED.inc()
+            return self._clients[namespace]
+
+    def clear(self):
+        """Forgets every client.  Intended for use in testing."""
+        with self._lock:
+            self._clients.clear()
+
+    def fetch_all(self, namespace, kind):
+        """Returns a list of every entity of the kind in the namespace.
+
+        Raises the last error if the query fails with a non-transient error,
+        or the retry budget would be exceeded by waiting to try again.
+        """
+        start = time.time()
+        backoff = self.initial_backoff
+        while True:
+            attempt_start = time.time()
+            try:
+                query = self.client(namespace).query(kind=kind)
+                return list(query.fetch(retry=no_library_retries(),
+                                        timeout=self.deadline))
+            except transient_datastore_errors() as exc:
+                delay = backoff * random.uniform(0.5, 1)
+                if time.time() + delay > start + self.retry_budget:
+                    DATASTORE_RETRY_SECONDS.inc(time.time() - attempt_start)
+                    raise
+                logging.warning('Retrying datastore query in %.1fs after: %s',
+                                delay, exc)
+                DATASTORE_RETRIES.inc()
+                DATASTORE_RETRY_SECONDS.inc(time.time() - attempt_start + delay)
+                time.sleep(delay)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    @DATASTORE_PROBE_TIMES.time()
+    def probe(self, namespace, kind, expect_entities=False):
+        """Returns a value that changes whenever the kind is written to.
+
+        The value is the key and change_property of the most recently changed
+        entity of the kind, which is found with a projection query that is
+        answered from the built-in index of change_property.  Writes that are
+        not the most recent, or that don't change change_property, go
+        undetected.  So do writes that leave the largest value the same:
+        lastcollectionattempt has a resolution of a minute, and datastore
+        breaks ties by key, so a second write within the same minute usually
+        leaves the probe unchanged.  That is why get_fleet_data still
+        refreshes its data every max_snapshot_age seconds.
+
+        Returns None if probing is disabled or fails, because then no two
+        probes should be considered equal.  Finding no entities at all counts
+        as a failure when expect_entities is set, because datastore also finds
+        nothing when change_property is missing or unindexed, and then the
+        probe would never change.
+        """
+        if not self.change_property:
+            return None
+        try:
+            query = self.client(namespace).query(
+                kind=kind, projection=[self.change_property],
+                order=['-' + self.change_property])
+            latest = list(query.fetch(limit=1, retry=no_library_retries(),
+                                      timeout=self.deadline))
+        # Probing is an optimization, and its failures are not otherwise
+        # handled, so catching an overly-broad exception is appropriate.
+        # pylint: disable=broad-except
+        except Exception as exc:
+            logging.warning('Unable to probe datastore for changes: %s',
+                            str(exc))
+            return None
+        # pylint: enable=broad-except
+        if not latest:
+            if expect_entities:
+                logging.warning('Probing for changes found no %s entities '
+                                'with an indexed %s, so changes to them '
+                                'cannot be detected', kind,
+                                self.change_property)
+                return None
+            return (None, None)
+        return latest[0].key.name, latest[0].get(self.change_property)
+
+
+# The datastore connections used by the whole program.
+DATASTORE_POOL = DatastorePool()
+
+
+# A datatype to hold the most recent fleet data fetched for get_fleet_data,
+# along with the probe value from just before the fetch, the fetch time, and
+# the time of the last refresh that found the data still current.
+FleetSnapshot = collections.namedtuple('FleetSnapshot',
+                                       ['data', 'probe', 'fetched', 'checked'])
+
+# The most recent FleetSnapshot for each namespace.
+_FLEET_SNAPSHOTS = {}
+
+
 @timed_locking_cache(seconds=30)
-@DATASTORE_TIMES.time()
 def get_fleet_data(namespace):
     """Returns a list of dictionaries, one for every entry requested.
 
     Each status has a dropboxrsyncaddress that contains rsync_url_fragment as a
     substring.
+
+    If datastore has not been written to since the last full fetch, according
+    to DatastorePool.probe, then the list returned by the last full fetch is
+    returned again.  Because the same list is returned, anything computed from
+    the previous snapshot of the fleet data remains valid.
     """
-    datastore_client = datastore.Client(namespace=namespace)
-    query = datastore_client.query(kind='dropboxrsyncaddress')
-    statuses = query.fetch()
-    return [status_to_dict(status) for status in statuses]
+    previous = _FLEET_SNAPSHOTS.get(namespace)
+    checked = time.time()
+    probe = DATASTORE_POOL.probe(
+        namespace, 'dropboxrsyncaddress',
+        expect_entities=previous is not None and bool(previous.data))
+    if (previous is not None and probe is not None and
+            previous.probe == probe and
+            checked - previous.fetched < DATASTORE_POOL.max_snapshot_age):
+        _FLEET_SNAPSHOTS[namespace] = previous._replace(checked=checked)
+        FLEET_REFRESHES_SKIPPED.inc()
+        return previous.data
+    fetched = time.time()
+    with DATASTORE_TIMES.time():
+        statuses = DATASTORE_POOL.fetch_all(namespace, 'dropboxrsyncaddress')
+    data = [status_to_dict(status) for status in statuses]
+    _FLEET_SNAPSHOTS[namespace] = FleetSnapshot(data=data, probe=probe,
+                                                fetched=fetched,
+                                                checked=fetched)
+    FLEET_REFRESHES_FETCHED.inc()
+    return data
+
+
+# Add a clear_snapshots method to get_fleet_data to aid in testing.  Code not in
+# a *_test.py file should not use this method.
+get_fleet_data.clear_snapshots = _FLEET_SNAPSHOTS.clear
 
 
 class WebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """Print the ground truth from cloud datastore."""
     namespace = 'test'
+    # The fraction of requests that are logged.
+    access_log_sample_rate = 1.0
 
     def do_GET(self):
         """Print out the ground truth from cloud datastore as a webpage."""
         parsed_path = urlparse.urlparse(self.path)
-        logging.info('Request of %s from %s', parsed_path.path,
-                     self.client_address)
+        if random.random() < WebHandler.access_log_sample_rate:
+            logging.info('Request of %s from %s', parsed_path.path,
+                         self.client_address)
         if parsed_path.path == '/':
             self.do_root_url()
         elif parsed_path.path == '/json_status':
-            self.do_scraper_status(parsed_path.query)
+            self.do_scraper_status(parsed_path.query,
+                                   accept=self.headers.get('Accept', ''))
+        elif parsed_path.path == '/healthz':
+            self.do_healthz()
+        elif parsed_path.path == '/readyz':
+            self.do_readyz()
         else:
             with REQUEST_TIMES_ERROR.time():
                 self.send_error(404)
 
+    # pylint: disable=redefined-builtin
+    def log_message(self, format, *args):
+        """Log through the logging module, instead of straight to stderr.
+
+        BaseHTTPRequestHandler writes a line to stderr for every request,
+        which duplicates the sampled access log of do_GET, so it is only logged
+        at DEBUG.  The client address is used as-is, because the
+        address_string() of the base class does a reverse DNS lookup.  The
+        message is formatted by logging, and so only if it is logged.
+        """
+        logging.debug('%s - ' + format, self.client_address[0], *args)
+
+    def log_error(self, format, *args):
+        """Log the errors of send_error, like 404s and 400s, as warnings.
+
+        BaseHTTPRequestHandler sends these through log_message, which would
+        hide them at the default log level.  RepeatedMessageFilter limits how
+        often they are logged.
+        """
+        logging.warning('%s - ' + format, self.client_address[0], *args)
+    # pylint: enable=redefined-builtin
+
+    @REQUEST_TIMES_HEALTH.time()
+    def do_healthz(self):
+        """Report that the webserver is up, for liveness probes."""
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+        self.end_headers()
+        print >> self.wfile, 'ok'
+
+    @REQUEST_TIMES_HEALTH.time()
+    def do_readyz(self):
+        """Report whether there is fleet data to serve, for readiness probes.
+
+        Until the first snapshot of the fleet data has been loaded, requests
+        for the fleet status would block on cloud datastore, so the server
+        reports that it is not ready yet.
+        """
+        age = get_snapshot_age(WebHandler.namespace)
+        self.send_response(200 if age is not None else 503)
+        self.send_header('Content-type', 'text/plain')
+        self.end_headers()
+        if age is None:
+            print >> self.wfile, 'not ready: no fleet data has been loaded'
+        else:
+            print >> self.wfile, 'ready: fleet data is %d seconds old' % age
+
     @REQUEST_TIMES_ROOT_URL.time()
     def do_root_url(self):
         """Draw a table when a request comes in for '/'."""
@@ -254,7 +672,7 @@ class WebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         print >> self.wfile, '</body></html>'
 
     @REQUEST_TIMES_JSON.time()
-    def do_scraper_status(self, query_string):
+    def do_scraper_status(self, query_string, accept=''):
         """Give the status, in JSON form, of the specified rsync endpoints.
 
         This returns a JSON list of JSON objects, because it will return the
@@ -263,25 +681,52 @@ class WebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         or anything else goes wrong with the parsing, then this will return the
         status of every endpoint with status in cloud datastore.
 
+        The experiment, machine, site, and rsync_module arguments restrict the
+        result to endpoints with exactly that value for that part of their
+        rsync url.  Each may be given more than once to allow several values.
+        The stale_after and fresh_within arguments are durations (e.g. '6h')
+        and restrict the result to endpoints whose last successful collection
+        was longer ago or more recent than that, respectively.  A malformed
+        duration results in a 400 error, because silently ignoring it would
+        return the wrong endpoints.
+
+        The response is JSON unless the format argument or the Accept header
+        asks for one of the other RESPONSE_FORMATS: newline-delimited JSON with
+        one endpoint per line, columnar JSON with one list per key, or msgpack.
+
         Args:
           query_string: the URL query string, not yet parsed.
+          accept: the Accept header of the request.
         """
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        data = urlparse.parse_qs(query_string)
-        rsync_url_fragment = data.get('rsync_filter', [])
-        if rsync_url_fragment:
-            rsync_url_fragment = rsync_url_fragment[0]
-        else:
-            rsync_url_fragment = ''
-        endpoints = [entry for entry in get_fleet_data(WebHandler.namespace)
-                     if rsync_url_fragment in entry['dropboxrsyncaddress']]
+        try:
+            query = parse_status_query(query_string)
+            response_format = negotiate_format(query.response_format, accept)
+        except SyncException as exc:
+            self.send_error(400, str(exc))
+            return
+        index = get_fleet_index(WebHandler.namespace)
+        positions = [position for position in
+                     index.select_positions(query.criteria, query.stale_after,
+                                            query.fresh_within)
+                     if query.rsync_filter in
+                     index.data[position]['dropboxrsyncaddress']]
         # The JSON should always encode a non-empty object (not string or array)
         # for reasons described here:
         #   https://www.owasp.org/index.php/AJAX_Security_Cheat_Sheet
-        output = {'result': endpoints}
-        print >> self.wfile, json.dumps(output)
+        # so every format except NDJSON wraps the endpoints in {'result': ...}
+        body = index.encode(positions, response_format)
+        self.send_response(200)
+        self.send_header('Content-type', RESPONSE_FORMATS[response_format])
+        # The body depends on the Accept header, so caches must key on it.
+        self.send_header('Vary', 'Accept')
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadingSimpleServer(SocketServer.ThreadingMixIn,
+                            BaseHTTPServer.HTTPServer):
+    """Use the threading mix-in to avoid forking or blocking."""
 
 
 def start_webserver_and_run_forever(port):  # pragma: no cover
@@ -290,15 +735,22 @@ def start_webserver_and_run_forever(port):  # pragma: no cover
     Code cribbed from prometheus_client.
     """
     server_address = ('', port)
-
-    class ThreadingSimpleServer(SocketServer.ThreadingMixIn,
-                                BaseHTTPServer.HTTPServer):
-        """Use the threading mix-in to avoid forking or blocking."""
-
     httpd = ThreadingSimpleServer(server_address, WebHandler)
     httpd.serve_forever()
 
 
+def start_metrics_server(port):  # pragma: no cover
+    """Starts serving metrics, and maybe debugging endpoints, in a thread.
+
+    This replaces prometheus_client.start_http_server, which can only serve
+    metrics.
+    """
+    httpd = ThreadingSimpleServer(('', port), DebugMetricsHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
 def parse_xdatetime(xdatetime):
     """Turn a datetime string into seconds since epoch.
 
@@ -310,7 +762,7 @@ def parse_xdatetime(xdatetime):
     if not xdatetime or xdatetime[0] != 'x':
         return None
     try:
-        parsed_datetime = dateutil.parser.parse(xdatetime[1:])
+        parsed_datetime = dateutil_parser.parse(xdatetime[1:])
         epoch = datetime.datetime(1970, 1, 1)
         return int((parsed_datetime - epoch).total_seconds())
     except ValueError:
@@ -331,6 +783,316 @@ def deconstruct_rsync_url(rsync_url):
         return match.group(1), match.group(2), match.group(3)
 
 
+# Multipliers to turn the (optional) unit suffix of a duration into seconds.
+DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def parse_duration(duration):
+    """Turn a duration string like '90', '30m', '6h', or '2d' into seconds.
+
+    Returns None if the string is not a valid duration.
+    """
+    match = re.match(r'^\s*(\d+)\s*([smhd]?)\s*$', duration)
+    if match is None:
+        return None
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+# The parsed form of the query string of a /json_status request.
+StatusQuery = collections.namedtuple(
+    'StatusQuery', ['rsync_filter', 'criteria', 'stale_after', 'fresh_within',
+                    'response_format'])
+
+
+def parse_status_query(query_string):
+    """Turns the query string of a /json_status request into a StatusQuery.
+
+    Raises SyncException if a staleness threshold is not a valid duration.
+    """
+    data = urlparse.parse_qs(query_string)
+    rsync_url_fragment = data.get('rsync_filter', [''])[0]
+    criteria = {}
+    for field in FleetIndex.INDEXED_FIELDS:
+        if data.get(field):
+            criteria[field] = data[field]
+    thresholds = {}
+    for threshold in ('stale_after', 'fresh_within'):
+        thresholds[threshold] = None
+        if data.get(threshold):
+            seconds = parse_duration(data[threshold][0])
+            if seconds is None:
+                raise SyncException('Bad duration for %s: %s' %
+                                    (threshold, data[threshold][0]))
+            thresholds[threshold] = seconds
+    return StatusQuery(rsync_filter=rsync_url_fragment, criteria=criteria,
+                       response_format=data.get('format', [''])[0],
+                       **thresholds)
+
+
+# The formats in which /json_status can respond, and their content types.
+RESPONSE_FORMATS = collections.OrderedDict([
+    ('json', 'application/json'),
+    ('ndjson', 'application/x-ndjson'),
+    ('columnar', 'application/vnd.mlab.columnar+json'),
+    ('msgpack', 'application/msgpack'),
+])
+
+# Media types that may be requested in an Accept header, and their formats.
+MEDIA_TYPE_FORMATS = {
+    'application/json': 'json',
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+    'application/vnd.mlab.columnar+json': 'columnar',
+    'application/msgpack': 'msgpack',
+    'application/x-msgpack': 'msgpack',
+}
+
+
+def available_formats():
+    """Returns the names of the response formats this server can produce."""
+    return [name for name in RESPONSE_FORMATS
+            if name != 'msgpack' or HAVE_MSGPACK]
+
+
+def negotiate_format(requested_format, accept):
+    """Chooses the response format for a /json_status request.
+
+    A format named in the query string takes precedence.  Otherwise the
+    available format with the highest quality in the Accept header is used,
+    with ties going to the one listed first, and JSON is the default.
+
+    Args:
+      requested_format: the value of the format argument, or ''
+      accept: the value of the Accept header, or ''
+
+    Returns:
+      The name of a response format.
+
+    Raises:
+      SyncException: if the requested format is unknown or unavailable
+    """
+    available = available_formats()
+    if requested_format:
+        if requested_format not in available:
+            raise SyncException('Unsupported format: %s' % requested_format)
+        return requested_format
+    best_format, best_quality = 'json', 0.0
+    for media_range in accept.split(','):
+        parameters = media_range.split(';')
+        media_type = parameters[0].strip().lower()
+        quality = 1.0
+        for parameter in parameters[1:]:
+            name, _, value = parameter.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        response_format = MEDIA_TYPE_FORMATS.get(media_type)
+        if response_format in available and quality > best_quality:
+            best_format, best_quality = response_format, quality
+    return best_format
+
+
+class FleetIndex(object):
+    """Indexes a single snapshot of the fleet data for structured queries.
+
+    Every list returned by a call to get_fleet_data that was not answered from
+    the cache is a new snapshot.  Each snapshot is indexed once, so that
+    requests don't have to parse every rsync url and timestamp in the fleet.
+    There is a hash index for every part of the rsync url, and an index of
+    every parseable lastsuccessfulcollection, sorted by time.  The indexes hold
+    positions in the snapshot, so results keep the order of the snapshot.
+    Every entry is also encoded at most once per response format, so that
+    responses can be assembled by joining pre-encoded entries.
+    """
+
+    INDEXED_FIELDS = ('experiment', 'machine', 'site', 'rsync_module')
+
+    def __init__(self, data):
+        self.data = data
+        self.created = time.time()
+        self.fields = dict((field, collections.defaultdict(set))
+                           for field in FleetIndex.INDEXED_FIELDS)
+        # Positions of entries without a successful collection on record.
+        self.never_collected = set()
+        collections_by_time = []
+        for position, entry in enumerate(data):
+            parts = deconstruct_rsync_url(entry['dropboxrsyncaddress'])
+            if parts is not None:
+                experiment, machine, rsync_module = parts
+                self.fields['experiment'][experiment].add(position)
+                self.fields['machine'][machine].add(position)
+                self.fields['site'][machine.split('.')[1]].add(position)
+                self.fields['rsync_module'][rsync_module].add(position)
+            timestamp = parse_xdatetime(entry.get('lastsuccessfulcollection'))
+            if timestamp is None:
+                self.never_collected.add(position)
+            else:
+                collections_by_time.append((timestamp, position))
+        collections_by_time.sort()
+        self.timestamps = [timestamp for timestamp, _ in collections_by_time]
+        self.positions = [position for _, position in collections_by_time]
+        # Encodings of the snapshot, filled in as they are requested.
+        self._rows = {}
+        self._bodies = {}
+
+    def select(self, criteria, stale_after=None, fresh_within=None, now=None):
+        """Returns the entries that satisfy every one of the passed-in limits.
+
+        The arguments are those of select_positions.
+        """
+        return [self.data[position] for position in
+                self.select_positions(criteria, stale_after, fresh_within, now)]
+
+    def select_positions(self, criteria, stale_after=None, fresh_within=None,
+                         now=None):
+        """Returns the positions of the entries that satisfy every limit.
+
+        Args:
+          criteria: a dict mapping names in INDEXED_FIELDS to a list of values,
+              any one of which is acceptable for that field
+          stale_after: if not None, only entries whose last successful
+              collection was more than this many seconds ago, or never
+              happened, are returned
+          fresh_within: if not None, only entries whose last successful
+              collection was at most this many seconds ago are returned
+          now: the current time in seconds since the epoch, for testing
+
+        Returns:
+          A sorted list of positions of entries in the snapshot.
+        """
+        positions = None
+        for field, values in criteria.items():
+            matches = set()
+            for value in values:
+                matches.update(self.fields[field].get(value, ()))
+            positions = matches if positions is None else positions & matches
+        if stale_after is not None or fresh_within is not None:
+            if now is None:
+                now = time.time()
+            start, end = 0, len(self.timestamps)
+            if fresh_within is not None:
+                start = bisect.bisect_left(self.timestamps, now - fresh_within)
+            if stale_after is not None:
+                end = bisect.bisect_left(self.timestamps, now - stale_after)
+            matches = set(self.positions[start:end])
+            if fresh_within is None:
+                matches.update(self.never_collected)
+            positions = matches if positions is None else positions & matches
+        if positions is None:
+            return range(len(self.data))
+        return sorted(positions)
+
+    def sizes(self):
+        """Returns the approximate sizes, in bytes, of the parts of the index.
+
+        The snapshot itself is not included.
+        """
+        return {
+            'indexes_bytes': approximate_size(
+                (self.fields, self.never_collected, self.timestamps,
+                 self.positions)),
+            'encoded_rows_bytes': approximate_size(self._rows),
+            'encoded_bodies_bytes': approximate_size(self._bodies),
+        }
+
+    def encoded_rows(self, response_format):
+        """Returns the entries of the snapshot, each encoded separately.
+
+        For the columnar format, this is a dict mapping each of KEYS to a list
+        of encoded values instead.  Each format is encoded at most once per
+        snapshot, the first time it is requested.
+        """
+        kind = 'json' if response_format == 'ndjson' else response_format
+        if kind not in self._rows:
+            if kind == 'columnar':
+                rows = dict((key, [json.dumps(entry.get(key, ''))
+                                   for entry in self.data])
+                            for key in KEYS)
+            elif kind == 'msgpack':
+                packer = msgpack.Packer(use_bin_type=False)
+                rows = [packer.pack(entry) for entry in self.data]
+            else:
+                rows = [json.dumps(entry) for entry in self.data]
+            self._rows[kind] = rows
+        return self._rows[kind]
+
+    def encode(self, positions, response_format):
+        """Returns the response body holding the entries at the positions.
+
+        Bodies are assembled from the per-entry encodings of encoded_rows, and
+        the body for the whole snapshot is saved for reuse.
+
+        Args:
+          positions: a sorted list of positions, as from select_positions
+          response_format: one of the keys of RESPONSE_FORMATS
+        """
+        whole_snapshot = len(positions) == len(self.data)
+        if whole_snapshot and response_format in self._bodies:
+            return self._bodies[response_format]
+        rows = self.encoded_rows(response_format)
+        if response_format == 'columnar':
+            body = '{"result": {%s}}\n' % ', '.join(
+                '%s: [%s]' % (json.dumps(key),
+                              ', '.join(rows[key][position]
+                                        for position in positions))
+                for key in KEYS)
+        elif response_format == 'msgpack':
+            packer = msgpack.Packer(use_bin_type=False)
+            body = (packer.pack_map_header(1) + packer.pack('result') +
+                    packer.pack_array_header(len(positions)) +
+                    ''.join(rows[position] for position in positions))
+        elif response_format == 'ndjson':
+            body = ''.join(rows[position] + '\n' for position in positions)
+        else:
+            body = '{"result": [%s]}\n' % ', '.join(rows[position]
+                                                    for position in positions)
+        if whole_snapshot:
+            self._bodies[response_format] = body
+        return body
+
+
+# The most recently built FleetIndex for each namespace.
+_FLEET_INDEXES = {}
+_FLEET_INDEXES_LOCK = threading.Lock()
+
+
+def get_fleet_index(namespace):
+    """Returns a FleetIndex of the current snapshot of the fleet data.
+
+    The index is only rebuilt when get_fleet_data returns a new snapshot.
+    """
+    data = get_fleet_data(namespace)
+    with _FLEET_INDEXES_LOCK:
+        index = _FLEET_INDEXES.get(namespace)
+        if index is None or index.data is not data:
+            index = FleetIndex(data)
+            _FLEET_INDEXES[namespace] = index
+        return index
+
+
+# Add a clear_cache method to get_fleet_index to aid in testing, like the one
+# timed_locking_cache adds.  Code not in a *_test.py file should not use it.
+get_fleet_index.clear_cache = _FLEET_INDEXES.clear
+
+
+def get_snapshot_age(namespace):
+    """Returns how many seconds ago the served fleet data was known current.
+
+    That is the time of the last refresh, whether it fetched the data or
+    found that it had not changed, so a skipped refresh doesn't age the data.
+    Returns None if no snapshot of the namespace has been indexed yet.
+    """
+    index = _FLEET_INDEXES.get(namespace)
+    if index is None:
+        return None
+    snapshot = _FLEET_SNAPSHOTS.get(namespace)
+    if snapshot is None or snapshot.data is not index.data:
+        return time.time() - index.created
+    return time.time() - snapshot.checked
+
+
 @timed_locking_cache(hours=1)
 def get_kubernetes_json():  # pragma: no cover
     """Get the status of the system, in JSON, from the kubernetes server."""
@@ -368,16 +1130,146 @@ def get_deployed_rsync_urls(namespace):
     return set(urls)
 
 
+# Upper bounds, in seconds, of the buckets of the collection lag histograms.
+COLLECTION_LAG_BUCKETS = (15 * 60, 30 * 60, 60 * 60, 2 * 60 * 60, 4 * 60 * 60,
+                          6 * 60 * 60, 12 * 60 * 60, 24 * 60 * 60,
+                          2 * 24 * 60 * 60, 4 * 24 * 60 * 60, 7 * 24 * 60 * 60)
+
+# The quantiles reported by the collection lag summaries.
+COLLECTION_LAG_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class CollectionLagAggregate(object):
+    """Last successful collection times of the fleet, by site and experiment.
+
+    This is built once for every combination of fleet data snapshot and set of
+    deployed rsync urls.  Because the collection lag of every endpoint grows at
+    the same rate, the sorted collection times of each group are all that is
+    needed to compute that group's lag histogram and quantiles at any later
+    time, using only bisection and subtraction.
+    """
+
+    GROUPINGS = ('site', 'experiment')
+
+    def __init__(self, data):
+        self.endpoints = dict((grouping, collections.Counter())
+                              for grouping in self.GROUPINGS)
+        self.timestamps = dict((grouping, collections.defaultdict(list))
+                               for grouping in self.GROUPINGS)
+        for fact in data:
+            rsync_url = fact['dropboxrsyncaddress']
+            parts = deconstruct_rsync_url(rsync_url)
+            if parts is None:
+                logging.error('Bad rsync url: %s', rsync_url)
+                continue
+            groups = {'site': parts[1].split('.')[1], 'experiment': parts[0]}
+            timestamp = parse_xdatetime(fact.get('lastsuccessfulcollection'))
+            for grouping, group in groups.items():
+                self.endpoints[grouping][group] += 1
+                if timestamp is not None:
+                    self.timestamps[grouping][group].append(timestamp)
+        self.sums = {}
+        for grouping in self.GROUPINGS:
+            self.sums[grouping] = {}
+            for group, timestamps in self.timestamps[grouping].items():
+                timestamps.sort()
+                self.sums[grouping][group] = sum(timestamps)
+
+    def metrics(self, now):
+        """Yields the lag histograms, lag summaries, and endpoint counts.
+
+        Endpoints without a parseable lastsuccessfulcollection are counted as
+        endpoints, but have no lag, so they are omitted from the histograms and
+        summaries.
+        """
+        for grouping in self.GROUPINGS:
+            histogram = prometheus_client.core.HistogramMetricFamily(
+                'scraper_%s_collection_lag_seconds' % grouping,
+                'Time since the last successful collection, by %s' % grouping,
+                labels=[grouping])
+            summary = prometheus_client.core.SummaryMetricFamily(
+                'scraper_%s_collection_lag_quantile_seconds' % grouping,
+                'Quantiles of the time since the last successful collection, '
+                'by %s' % grouping,
+                labels=[grouping])
+            endpoints = prometheus_client.core.GaugeMetricFamily(
+                'scraper_%s_endpoints' % grouping,
+                'Number of deployed rsync endpoints, by %s' % grouping,
+                labels=[grouping])
+            for group in sorted(self.endpoints[grouping]):
+                timestamps = self.timestamps[grouping].get(group, [])
+                count = len(timestamps)
+                lag_sum = count * now - self.sums[grouping].get(group, 0)
+                buckets = [(str(bound),
+                            count - bisect.bisect_left(timestamps, now - bound))
+                           for bound in COLLECTION_LAG_BUCKETS]
+                buckets.append(('+Inf', count))
+                histogram.add_metric([group], buckets, lag_sum)
+                summary.add_metric([group], count, lag_sum)
+                if count:
+                    # The largest lag belongs to the smallest timestamp.
+                    for quantile in COLLECTION_LAG_QUANTILES:
+                        position = min(int(quantile * count), count - 1)
+                        summary.add_sample(
+                            summary.name,
+                            {grouping: group, 'quantile': str(quantile)},
+                            now - timestamps[count - 1 - position])
+                endpoints.add_metric([group], self.endpoints[grouping][group])
+            yield histogram
+            yield summary
+            yield endpoints
+
+
 class PrometheusDatastoreCollector(object):
-    """A collector to forward the contents of cloud datastore to prometheus."""
+    """A collector to forward the contents of cloud datastore to prometheus.
+
+    In 'endpoint' mode, three gauges are exported for every rsync endpoint.  In
+    'aggregate' mode, collection lag histograms and summaries are exported for
+    every site and experiment instead, and in 'both' mode both are exported.
+    """
 
-    def __init__(self, namespace):
+    def __init__(self, namespace, mode='endpoint'):
         self.namespace = namespace
+        self.mode = mode
+        # The (fleet data, deployed urls, CollectionLagAggregate) most recently
+        # used for aggregate metrics, kept in a single tuple so that
+        # concurrent collections never see a partially-updated combination.
+        self._aggregate = (None, None, None)
+
+    # The registry looks for describe() on the collector, so it must be a
+    # method even though it doesn't use self.
+    # pylint: disable=no-self-use
+    def describe(self):
+        """Describe no metrics up front, so that registering does no I/O.
+
+        Without this method, registering the collector calls collect(), which
+        loads the fleet data and the kubernetes deployments before anything
+        else at startup has happened.
+        """
+        return []
+    # pylint: enable=no-self-use
 
     @REQUEST_TIMES_COLLECT.time()
     def collect(self):
         """Get the data from cloud datastore and yield a series of metrics."""
-
+        deployed_urls = get_deployed_rsync_urls(self.namespace)
+        data = get_fleet_data(self.namespace)
+        if self.mode in ('endpoint', 'both'):
+            for metric in self.collect_endpoints(data, deployed_urls):
+                yield metric
+        if self.mode in ('aggregate', 'both'):
+            last_data, last_urls, aggregate = self._aggregate
+            if last_data is not data or last_urls != deployed_urls:
+                aggregate = CollectionLagAggregate(
+                    [x for x in data
+                     if x['dropboxrsyncaddress'] in deployed_urls])
+                self._aggregate = (data, deployed_urls, aggregate)
+            for metric in aggregate.metrics(time.time()):
+                yield metric
+
+    @staticmethod
+    def collect_endpoints(data, deployed_urls):
+        """Yield the per-endpoint metrics of the deployed parts of the data."""
         last_success = prometheus_client.core.GaugeMetricFamily(
             'scraper_lastsuccessfulcollection',
             'Time of the last successful collection',
@@ -390,9 +1282,7 @@ class PrometheusDatastoreCollector(object):
             'scraper_maxrawfiletimearchived',
             'Time before which files may be deleted',
             labels=['experiment', 'machine', 'rsync_module'])
-        deployed_urls = get_deployed_rsync_urls(self.namespace)
-        data = [x for x in get_fleet_data(self.namespace)
-                if x['dropboxrsyncaddress'] in deployed_urls]
+        data = [x for x in data if x['dropboxrsyncaddress'] in deployed_urls]
         for fact in data:
             rsync_url = fact['dropboxrsyncaddress']
             labels = deconstruct_rsync_url(rsync_url)
@@ -418,26 +1308,395 @@ class PrometheusDatastoreCollector(object):
         yield max_filetime
 
 
+def approximate_size(obj):
+    """Returns the approximate number of bytes used by obj and its contents.
+
+    The contents of dicts, lists, tuples, and sets are followed, and every
+    object is only counted once.  Other objects are counted as just their own
+    size, which is exact for the strings and numbers that make up the fleet
+    data.
+    """
+    seen = set()
+    pending = [obj]
+    total = 0
+    while pending:
+        current = pending.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current)
+        if isinstance(current, dict):
+            pending.extend(current.keys())
+            pending.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            pending.extend(current)
+    return total
+
+
+# The innermost frames of threads that are blocked waiting for work: in
+# Condition.wait, which Queue.get, Event.wait and Thread.join all use, or in
+# the select() loop of SocketServer.serve_forever.
+IDLE_FRAMES = frozenset([('threading.py', 'wait'),
+                         ('SocketServer.py', '_eintr_retry')])
+
+
+def sample_stacks(seconds, interval=0.005, include_idle=False):
+    """Samples the stacks of every other thread for the given time.
+
+    This is a wall-clock profile: a thread is seen wherever it is, whether it
+    is running or blocked.  Unless include_idle is set, samples of threads
+    waiting in one of the IDLE_FRAMES are dropped, so that what remains is
+    close to a CPU profile, along with time spent blocked on I/O.
+
+    Returns:
+      A Counter mapping each stack, in the 'collapsed' format read by flame
+      graph tools (outermost frame first, separated by semicolons), to the
+      number of times it was seen.
+    """
+    own_thread = threading.current_thread().ident
+    stacks = collections.Counter()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        # pylint: disable=protected-access
+        frames = sys._current_frames()
+        # pylint: enable=protected-access
+        for thread_id, frame in frames.items():
+            if thread_id == own_thread:
+                continue
+            if not include_idle and (
+                    os.path.basename(frame.f_code.co_filename),
+                    frame.f_code.co_name) in IDLE_FRAMES:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (os.path.basename(code.co_filename),
+                                        code.co_name))
+                frame = frame.f_back
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def count_objects_by_type():
+    """Returns a Counter of the objects tracked by the garbage collector.
+
+    Python 2 has no tracemalloc, so this is the closest available measure of
+    what is using memory: every container object, counted by type name.
+    """
+    return collections.Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+def describe_snapshots():
+    """Returns the sizes of the live fleet data, its indexes, and the caches."""
+    description = {
+        'fleet_data': {},
+        'fleet_indexes': {},
+        'cached_results': {
+            'get_fleet_data': get_fleet_data.cache_size(),
+            'get_kubernetes_json': get_kubernetes_json.cache_size(),
+        },
+    }
+    for namespace, snapshot in _FLEET_SNAPSHOTS.items():
+        description['fleet_data'][namespace] = {
+            'entries': len(snapshot.data),
+            'approximate_bytes': approximate_size(snapshot.data),
+            'age_seconds': time.time() - snapshot.fetched,
+        }
+    for namespace, index in _FLEET_INDEXES.items():
+        description['fleet_indexes'][namespace] = index.sizes()
+    return description
+
+
+class DebugMetricsHandler(prometheus_client.MetricsHandler):
+    """Serves prometheus metrics, and optionally endpoints for debugging.
+
+    When debug_enabled is set, these are served in addition to the metrics:
+      /debug/profile?seconds=N  CPU profile of the other threads for N seconds
+                                (default 10, at most 60), as collapsed stacks
+      /debug/memory             Top object types and the peak RSS, as JSON.
+                                Also saves the counts for /debug/memory/diff
+      /debug/memory/diff        How object counts changed since /debug/memory
+      /debug/snapshot           Sizes of the fleet data, indexes, and caches
+    """
+    debug_enabled = False
+    # Object counts from the last call to /debug/memory.
+    memory_baseline = None
+    # Held while a profile is running, so that only one runs at a time.
+    profile_lock = threading.Lock()
+    # The number of types to list for /debug/memory and /debug/memory/diff.
+    top_types = 50
+
+    def do_GET(self):
+        """Serve a debugging endpoint, or else the metrics."""
+        parsed_path = urlparse.urlparse(self.path)
+        if not DebugMetricsHandler.debug_enabled or \
+                not parsed_path.path.startswith('/debug/'):
+            prometheus_client.MetricsHandler.do_GET(self)
+        elif parsed_path.path == '/debug/profile':
+            self.do_profile(parsed_path.query)
+        elif parsed_path.path == '/debug/memory':
+            self.do_memory()
+        elif parsed_path.path == '/debug/memory/diff':
+            self.do_memory_diff()
+        elif parsed_path.path == '/debug/snapshot':
+            self.send_json(describe_snapshots())
+        else:
+            self.send_error(404)
+
+    def send_json(self, value):
+        """Send value, encoded as JSON, as a successful response."""
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        print >> self.wfile, json.dumps(value, indent=2, sort_keys=True)
+
+    def do_profile(self, query_string):
+        """Sample the stacks of every thread and send the collapsed stacks.
+
+        Threads waiting for work are left out, unless the idle argument is 1.
+        """
+        query = urlparse.parse_qs(query_string)
+        seconds = query.get('seconds', ['10'])[0]
+        include_idle = query.get('idle', ['0'])[0] == '1'
+        try:
+            seconds = float(seconds)
+        except ValueError:
+            seconds = -1
+        if not 0 < seconds <= 60:
+            self.send_error(400, 'seconds must be in (0, 60]')
+            return
+        if not DebugMetricsHandler.profile_lock.acquire(False):
+            self.send_error(409, 'A profile is already running')
+            return
+        try:
+            stacks = sample_stacks(seconds, include_idle=include_idle)
+        finally:
+            DebugMetricsHandler.profile_lock.release()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+        self.end_headers()
+        for stack, count in stacks.most_common():
+            print >> self.wfile, stack, count
+
+    def do_memory(self):
+        """Send the most common object types, and save the counts."""
+        counts = count_objects_by_type()
+        DebugMetricsHandler.memory_baseline = counts
+        self.send_json({
+            'max_rss_kilobytes': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+            'gc_tracked_objects': sum(counts.values()),
+            'top_types': counts.most_common(DebugMetricsHandler.top_types),
+        })
+
+    def do_memory_diff(self):
+        """Send the largest changes in object counts since /debug/memory."""
+        baseline = DebugMetricsHandler.memory_baseline
+        if baseline is None:
+            self.send_error(409, 'Visit /debug/memory first to save a baseline')
+            return
+        counts = count_objects_by_type()
+        changes = [(name, counts[name] - baseline[name])
+                   for name in set(counts) | set(baseline)
+                   if counts[name] != baseline[name]]
+        changes.sort(key=lambda change: (-abs(change[1]), change[0]))
+        self.send_json({'changes': changes[:DebugMetricsHandler.top_types]})
+
+
+# The format of every logged line.
+LOG_FORMAT = '[%(asctime)s %(levelname)s %(filename)s:%(lineno)d] %(message)s'
+
+
+class QueueHandler(logging.Handler):
+    """A logging handler that puts records on a queue instead of writing them.
+
+    Logging from a request thread then costs no more than a non-blocking put,
+    and formatting and writing happen on the thread of a QueueListener.  If the
+    queue is full, the record is dropped rather than making the thread wait.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        """Put the record on the queue, or drop it if the queue is full."""
+        if record.exc_info:
+            # A traceback keeps every frame in it alive, so it is formatted now
+            # instead of whenever the listener gets to it.
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+class QueueListener(threading.Thread):
+    """A thread that passes the log records on a queue to some handlers."""
+
+    def __init__(self, queue, *handlers):
+        threading.Thread.__init__(self, name='QueueListener')
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+
+    def run(self):
+        """Handle records until stop() is called."""
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Handle every record that is already queued, and then stop."""
+        self.queue.put(None)
+        self.join()
+
+
+class RepeatedMessageFilter(logging.Filter):
+    """A logging filter that limits how often the same problem is logged.
+
+    Warnings and errors from the same line of code, like the 'Bad rsync url'
+    error that is logged for every bad entry of the fleet data each time it is
+    read, are passed at most once per interval.  The first record passed after
+    others were suppressed says how many were suppressed.  Less severe records
+    always pass.
+    """
+
+    def __init__(self, interval):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        # Maps (pathname, lineno) to [time last passed, number suppressed].
+        self._history = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        """Returns whether the record should be logged."""
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            history = self._history.get(key)
+            if history is not None and \
+                    record.created - history[0] < self.interval:
+                history[1] += 1
+                LOG_RECORDS_SUPPRESSED.inc()
+                return False
+            suppressed = history[1] if history is not None else 0
+            self._history[key] = [record.created, 0]
+        if suppressed:
+            record.msg = '%s [%d similar messages suppressed]' % (
+                record.msg, suppressed)
+        return True
+
+
+def setup_logging(level, queue_size, repeated_log_interval):
+    """Send log records through a queue to be written to stderr.
+
+    Returns the QueueListener doing the writing, which is stopped when the
+    program exits so that queued records are not lost.
+    """
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    queue = Queue.Queue(queue_size)
+    queue_handler = QueueHandler(queue)
+    queue_handler.addFilter(RepeatedMessageFilter(repeated_log_interval))
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.addHandler(queue_handler)
+    listener = QueueListener(queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def warm_up(namespace, retry_interval=5):
+    """Loads the fleet data and the kubernetes deployments in parallel.
+
+    The two are independent and each can take seconds, so they are loaded at
+    the same time.  Loading the fleet data is retried until it succeeds,
+    because the server is not ready until it has.  The kubernetes deployments
+    are only needed for monitoring, and will be retried when next needed.
+    """
+    def load_fleet_data():
+        """Load and index the fleet data, trying until it works."""
+        while True:
+            try:
+                get_fleet_index(namespace)
+                break
+            # Any error here will be retried, so catching an overly-broad
+            # exception is appropriate.
+            # pylint: disable=broad-except
+            except Exception as exc:
+                logging.error('Unable to load fleet data at startup: %s',
+                              str(exc))
+                time.sleep(retry_interval)
+            # pylint: enable=broad-except
+        STARTUP_SECONDS.set(time.time() - PROCESS_START_TIME)
+
+    def load_kubernetes_json():
+        """Load the kubernetes deployments, or log why they can't be."""
+        try:
+            get_kubernetes_json()
+        # pylint: disable=broad-except
+        except Exception as exc:
+            logging.error('Unable to load kubernetes deployments at startup: '
+                          '%s', str(exc))
+        # pylint: enable=broad-except
+
+    threads = [threading.Thread(target=load_fleet_data),
+               threading.Thread(target=load_kubernetes_json)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
 def main(argv):  # pragma: no cover
     """Serve up the contents of cloud datastore to all who ask.
 
-    Set up the logging, parse the command line, set up monitoring, set up the
-    datastore client, set up the spreadsheet client, set up the webserver, and
-    then httpd.serve_forever().
+    Parse the command line, set up the logging, set up monitoring, start
+    loading the fleet data in the background, set up the webserver, and then
+    httpd.serve_forever().
     """
-    # Set up logging
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format='[%(asctime)s %(levelname)s %(filename)s:%(lineno)d] '
-               '%(message)s')
     # Parse the commandline
     args = parse_args(argv[1:])
+    # Set up logging
+    setup_logging(getattr(logging, args.log_level), args.log_queue_size,
+                  args.repeated_log_interval)
     WebHandler.namespace = args.datastore_namespace
+    WebHandler.access_log_sample_rate = args.access_log_sample_rate
+    DATASTORE_POOL.deadline = args.datastore_deadline
+    DATASTORE_POOL.retry_budget = args.datastore_retry_budget
+    DATASTORE_POOL.change_property = args.change_probe_property
+    DATASTORE_POOL.max_snapshot_age = args.max_snapshot_age
+    if args.fleet_backend == 'fake':
+        DATASTORE_POOL.client_factory = fake_datastore.FakeDatastore(
+            entities=args.fake_entities,
+            page_size=args.fake_page_size,
+            page_latency=args.fake_page_latency,
+            latency_jitter=args.fake_latency_jitter,
+            error_rate=args.fake_error_rate,
+            writes_per_second=args.fake_writes_per_second).client
     # Set up the prometheus sync job
     prometheus_client.core.REGISTRY.register(
-        PrometheusDatastoreCollector(args.datastore_namespace))
+        PrometheusDatastoreCollector(args.datastore_namespace,
+                                     args.metrics_mode))
     # Set up the monitoring
-    prometheus_client.start_http_server(args.prometheus_port)
+    DebugMetricsHandler.debug_enabled = args.enable_debug_endpoints
+    start_metrics_server(args.prometheus_port)
+    # Load the data in the background, so that /healthz and /readyz can be
+    # answered while it loads.
+    warm_up_thread = threading.Thread(target=warm_up,
+                                      args=(args.datastore_namespace,))
+    warm_up_thread.daemon = True
+    warm_up_thread.start()
     start_webserver_and_run_forever(args.webserver_port)
 
 
@@ -24,16 +24,26 @@
 
 import datetime
 import json
+import logging
+import logging.handlers
+import os
+import Queue
 import StringIO
+import subprocess
+import sys
 import threading
+import time
 import unittest
 
 import freezegun
 import mock
+import msgpack
+import prometheus_client
 import requests
 import testfixtures
 
 # pylint: disable=no-name-in-module
+from google.api_core import exceptions as api_exceptions
 from google.cloud import datastore
 import google.auth.credentials
 # pylint: enable=no-name-in-module
@@ -115,7 +125,11 @@ class TestSync(unittest.TestCase):
         self.mock_handler = mock.Mock(sync.WebHandler)
         self.mock_handler.wfile = StringIO.StringIO()
         self.mock_handler.client_address = (1234, '127.0.0.1')
+        self.mock_handler.headers = {}
         sync.get_fleet_data.clear_cache()
+        sync.get_fleet_data.clear_snapshots()
+        sync.get_fleet_index.clear_cache()
+        sync.DATASTORE_POOL.clear()
 
     def tearDown(self):
         self.json_patcher.stop()
@@ -130,6 +144,19 @@ class TestSync(unittest.TestCase):
         self.assertIs(type(args.datastore_namespace), str)
         self.assertIs(type(args.prometheus_port), int)
         self.assertIs(type(args.webserver_port), int)
+        self.assertIs(type(args.datastore_deadline), float)
+        self.assertIs(type(args.datastore_retry_budget), float)
+        self.assertIs(type(args.change_probe_property), str)
+        self.assertIs(type(args.max_snapshot_age), float)
+        self.assertIs(type(args.access_log_sample_rate), float)
+        self.assertIs(type(args.log_queue_size), int)
+        self.assertIs(type(args.repeated_log_interval), float)
+        self.assertIn(args.log_level, ['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+        self.assertFalse(args.enable_debug_endpoints)
+        self.assertEqual(args.fleet_backend, 'datastore')
+        self.assertIs(type(args.fake_entities), int)
+        self.assertIs(type(args.fake_error_rate), float)
+        self.assertIn(args.metrics_mode, sync.METRICS_MODES)
 
     def test_get_fleet_data(self):
         returned_answers = sync.get_fleet_data('scraper')
@@ -174,6 +201,173 @@ class TestSync(unittest.TestCase):
                       if 'sea02' in x['dropboxrsyncaddress']]
         self.assertItemsEqual(sea02_only, [sea02_switch])
 
+    @mock.patch.object(sync, 'datastore')
+    def test_datastore_pool_reuses_clients(self, mock_datastore):
+        pool = sync.DatastorePool()
+        self.assertIs(pool.client('scraper'), pool.client('scraper'))
+        pool.client('other')
+        self.assertEqual(mock_datastore.Client.call_count, 2)
+        pool.clear()
+        pool.client('scraper')
+        self.assertEqual(mock_datastore.Client.call_count, 3)
+
+    @mock.patch.object(sync, 'datastore')
+    def test_datastore_pool_client_factory(self, mock_datastore):
+        factory = mock.Mock()
+        pool = sync.DatastorePool(client_factory=factory)
+        self.assertIs(pool.client('scraper'), factory.return_value)
+        factory.assert_called_once_with(namespace='scraper')
+        self.assertEqual(mock_datastore.Client.call_count, 0)
+
+    @mock.patch.object(sync, 'datastore')
+    def test_datastore_pool_deadline(self, mock_datastore):
+        pool = sync.DatastorePool(deadline=7)
+        pool.fetch_all('scraper', 'dropboxrsyncaddress')
+        fetch = mock_datastore.Client().query().fetch
+        self.assertEqual(fetch.call_args[1]['timeout'], 7)
+        # pylint: disable=protected-access
+        self.assertFalse(fetch.call_args[1]['retry']._predicate(
+            api_exceptions.ServiceUnavailable('down')))
+        # pylint: enable=protected-access
+
+    @mock.patch.object(sync, 'datastore')
+    def test_datastore_pool_retries_transient_errors(self, mock_datastore):
+        fetch = mock_datastore.Client().query().fetch
+        fetch.side_effect = [api_exceptions.ServiceUnavailable('down'),
+                             api_exceptions.DeadlineExceeded('slow'),
+                             ['entity']]
+        pool = sync.DatastorePool()
+        with freezegun.freeze_time('2017-03-28') as frozen_time:
+            with mock.patch.object(sync.time, 'sleep',
+                                   side_effect=frozen_time.tick) as sleep:
+                self.assertEqual(
+                    pool.fetch_all('scraper', 'dropboxrsyncaddress'),
+                    ['entity'])
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(fetch.call_count, 3)
+
+    @mock.patch.object(sync, 'datastore')
+    def test_datastore_pool_retry_budget(self, mock_datastore):
+        fetch = mock_datastore.Client().query().fetch
+        fetch.side_effect = api_exceptions.ServiceUnavailable('down')
+        pool = sync.DatastorePool(retry_budget=10, initial_backoff=1,
+                                  max_backoff=4)
+        with freezegun.freeze_time('2017-03-28') as frozen_time:
+            with mock.patch.object(sync.time, 'sleep',
+                                   side_effect=frozen_time.tick) as sleep:
+                with self.assertRaises(api_exceptions.ServiceUnavailable):
+                    pool.fetch_all('scraper', 'dropboxrsyncaddress')
+        self.assertLessEqual(sum(x[0][0] for x in sleep.call_args_list), 10)
+        self.assertGreater(sleep.call_count, 1)
+
+    @mock.patch.object(sync, 'datastore')
+    def test_datastore_pool_does_not_retry_other_errors(self, mock_datastore):
+        fetch = mock_datastore.Client().query().fetch
+        fetch.side_effect = api_exceptions.PermissionDenied('no')
+        with self.assertRaises(api_exceptions.PermissionDenied):
+            sync.DatastorePool().fetch_all('scraper', 'dropboxrsyncaddress')
+        self.assertEqual(fetch.call_count, 1)
+
+    def full_fetch_count(self, fetch):
+        return len([x for x in fetch.call_args_list if 'limit' not in x[1]])
+
+    @mock.patch.object(sync, 'datastore')
+    def test_get_fleet_data_skips_refresh_when_unchanged(self, mock_datastore):
+        fetch = mock_datastore.Client().query().fetch
+        fetch.return_value = self.test_datastore_data
+        with freezegun.freeze_time('2017-03-28') as frozen_time:
+            data = sync.get_fleet_data('scraper')
+            frozen_time.tick(datetime.timedelta(minutes=1))
+            self.assertIs(sync.get_fleet_data('scraper'), data)
+            # Two probes and one full fetch.
+            self.assertEqual(self.full_fetch_count(fetch), 1)
+            self.assertEqual(fetch.call_count, 3)
+            self.assertEqual(
+                mock_datastore.Client().query.call_args[1],
+                {'kind': 'dropboxrsyncaddress',
+                 'projection': ['lastcollectionattempt'],
+                 'order': ['-lastcollectionattempt']})
+
+            # A write to datastore changes the result of the probe.
+            self.test_datastore_data[0]['lastcollectionattempt'] = 'x2017-04'
+            frozen_time.tick(datetime.timedelta(minutes=1))
+            changed_data = sync.get_fleet_data('scraper')
+            self.assertIsNot(changed_data, data)
+            self.assertEqual(self.full_fetch_count(fetch), 2)
+
+            # Even without changes, the data is eventually refreshed.
+            frozen_time.tick(datetime.timedelta(minutes=3))
+            self.assertIsNot(sync.get_fleet_data('scraper'), changed_data)
+            self.assertEqual(self.full_fetch_count(fetch), 3)
+
+    @mock.patch.object(sync, 'datastore')
+    def test_get_fleet_data_misses_same_value_write(self, mock_datastore):
+        fetch = mock_datastore.Client().query().fetch
+        fetch.return_value = self.test_datastore_data
+        with freezegun.freeze_time('2017-03-28') as frozen_time:
+            data = sync.get_fleet_data('scraper')
+            # A write within the same minute leaves the probe unchanged.
+            self.test_datastore_data[0]['maxrawfilemtimearchived'] = 1490750000
+            frozen_time.tick(datetime.timedelta(minutes=1))
+            self.assertIs(sync.get_fleet_data('scraper'), data)
+            self.assertEqual(data[0]['maxrawfilemtimearchived'], 1490746201)
+
+            # The write is picked up once the snapshot is max_snapshot_age old.
+            frozen_time.tick(datetime.timedelta(minutes=1, seconds=1))
+            refreshed = sync.get_fleet_data('scraper')
+            self.assertEqual(refreshed[0]['maxrawfilemtimearchived'],
+                             1490750000)
+            self.assertEqual(self.full_fetch_count(fetch), 2)
+
+    @mock.patch.object(sync, 'datastore')
+    def test_get_fleet_data_without_probe(self, mock_datastore):
+        fetch = mock_datastore.Client().query().fetch
+        fetch.return_value = self.test_datastore_data
+        with mock.patch.object(sync.DATASTORE_POOL, 'change_property', ''):
+            data = sync.get_fleet_data('scraper')
+            sync.get_fleet_data.clear_cache()
+            self.assertIsNot(sync.get_fleet_data('scraper'), data)
+        self.assertEqual(self.full_fetch_count(fetch), 2)
+        self.assertEqual(fetch.call_count, 2)
+
+    @testfixtures.log_capture()
+    @mock.patch.object(sync, 'datastore')
+    def test_get_fleet_data_probe_failure(self, mock_datastore, log):
+        def fetch_or_fail(limit=None, **_kwargs):
+            if limit is not None:
+                raise api_exceptions.PermissionDenied('no index')
+            return self.test_datastore_data
+        fetch = mock_datastore.Client().query().fetch
+        fetch.side_effect = fetch_or_fail
+        data = sync.get_fleet_data('scraper')
+        sync.get_fleet_data.clear_cache()
+        self.assertIsNot(sync.get_fleet_data('scraper'), data)
+        self.assertEqual(self.full_fetch_count(fetch), 2)
+        self.assertIn('WARNING', [x.levelname for x in log.records])
+
+    def test_datastore_pool_probe_empty_kind(self):
+        pool = sync.DatastorePool()
+        with mock.patch.object(pool, 'client') as client:
+            client().query().fetch.return_value = []
+            self.assertEqual(pool.probe('scraper', 'dropboxrsyncaddress'),
+                             (None, None))
+
+    @testfixtures.log_capture()
+    @mock.patch.object(sync, 'datastore')
+    def test_get_fleet_data_probe_finds_nothing(self, mock_datastore, log):
+        # Datastore finds nothing when the probed property is unindexed.
+        def fetch_or_nothing(limit=None, **_kwargs):
+            if limit is not None:
+                return []
+            return self.test_datastore_data
+        fetch = mock_datastore.Client().query().fetch
+        fetch.side_effect = fetch_or_nothing
+        data = sync.get_fleet_data('scraper')
+        sync.get_fleet_data.clear_cache()
+        self.assertIsNot(sync.get_fleet_data('scraper'), data)
+        self.assertEqual(self.full_fetch_count(fetch), 2)
+        self.assertIn('WARNING', [x.levelname for x in log.records])
+
     def test_do_get(self):
         sync.WebHandler.do_root_url(self.mock_handler)
         self.assertEqual(self.mock_handler.wfile.getvalue().count('<tr>'), 4)
@@ -292,6 +486,64 @@ class TestSync(unittest.TestCase):
                 self.assertNotEqual(sample[1]['machine'],
                                     'lhr01.measurement-lab.org')
 
+    @mock.patch.object(sync, 'get_fleet_data')
+    @mock.patch.object(sync, 'get_deployed_rsync_urls')
+    def test_prometheus_register_does_no_io(self, mock_rsync_urls,
+                                            mock_fleet_data):
+        registry = prometheus_client.core.CollectorRegistry(
+            auto_describe=True)
+        registry.register(sync.PrometheusDatastoreCollector('scraper'))
+        self.assertFalse(mock_rsync_urls.called)
+        self.assertFalse(mock_fleet_data.called)
+
+    def test_prometheus_aggregate_mode(self):
+        collector = sync.PrometheusDatastoreCollector('scraper', 'aggregate')
+        with freezegun.freeze_time('2017-03-28 06:00:00'):
+            metrics = dict((x.name, x) for x in collector.collect())
+        self.assertEqual(set(metrics),
+                         set(['scraper_site_collection_lag_seconds',
+                              'scraper_site_collection_lag_quantile_seconds',
+                              'scraper_site_endpoints',
+                              'scraper_experiment_collection_lag_seconds',
+                              'scraper_experiment_collection_lag_quantile_'
+                              'seconds',
+                              'scraper_experiment_endpoints']))
+        samples = dict(
+            ((x[0], tuple(sorted(x[1].items()))), x[2])
+            for x in metrics['scraper_site_collection_lag_seconds'].samples)
+        # Both prg01 endpoints were collected six hours ago.
+        self.assertEqual(samples[('scraper_site_collection_lag_seconds_count',
+                                  (('site', 'prg01'),))], 2)
+        self.assertEqual(samples[('scraper_site_collection_lag_seconds_sum',
+                                  (('site', 'prg01'),))], 2 * 6 * 60 * 60)
+        self.assertEqual(samples[('scraper_site_collection_lag_seconds_bucket',
+                                  (('le', '14400'), ('site', 'prg01')))], 0)
+        self.assertEqual(samples[('scraper_site_collection_lag_seconds_bucket',
+                                  (('le', '21600'), ('site', 'prg01')))], 2)
+        # The sea02 endpoint was never successfully collected.
+        self.assertEqual(samples[('scraper_site_collection_lag_seconds_count',
+                                  (('site', 'sea02'),))], 0)
+        endpoints = dict((x[1]['site'], x[2])
+                         for x in metrics['scraper_site_endpoints'].samples)
+        self.assertEqual(endpoints, {'prg01': 2, 'sea02': 1})
+        summary = metrics['scraper_experiment_collection_lag_quantile_seconds']
+        quantiles = [x[2] for x in summary.samples if 'quantile' in x[1]]
+        self.assertEqual(quantiles, [6 * 60 * 60] * 3)
+
+    # pylint: disable=protected-access
+    def test_prometheus_aggregate_reused_for_same_snapshot(self):
+        collector = sync.PrometheusDatastoreCollector('scraper', 'both')
+        metrics = list(collector.collect())
+        self.assertEqual(len(metrics), 9)
+        aggregate = collector._aggregate[2]
+        list(collector.collect())
+        self.assertIs(collector._aggregate[2], aggregate)
+        sync.get_fleet_data.clear_cache()
+        sync.get_fleet_data.clear_snapshots()
+        list(collector.collect())
+        self.assertIsNot(collector._aggregate[2], aggregate)
+    # pylint: enable=protected-access
+
     def test_deconstruct_rsync_url(self):
         self.assertEqual(
             sync.deconstruct_rsync_url(
@@ -405,6 +657,141 @@ class TestSync(unittest.TestCase):
         self.assertEqual(self.mock_handler.do_scraper_status.call_count, 1)
         self.assertEqual(self.mock_handler.do_scraper_status.call_args[0],
                          ('rsync_filter=thing',))
+        self.assertEqual(self.mock_handler.do_scraper_status.call_args[1],
+                         {'accept': ''})
+
+    def test_heavy_modules_imported_lazily(self):
+        code = ('import sys, sync; '
+                'print(sorted(set(["google.cloud.datastore", "dateutil.parser",'
+                ' "msgpack"]) & set(sys.modules)))')
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(sync.__file__)))
+        self.assertEqual(output.strip(), '[]')
+
+    def test_do_get_healthz(self):
+        self.mock_handler.path = '/healthz'
+        sync.WebHandler.do_GET(self.mock_handler)
+        self.assertEqual(self.mock_handler.do_healthz.call_count, 1)
+        sync.WebHandler.do_healthz(self.mock_handler)
+        self.mock_handler.send_response.assert_called_with(200)
+
+    def test_do_get_readyz(self):
+        self.mock_handler.path = '/readyz'
+        sync.WebHandler.do_GET(self.mock_handler)
+        self.assertEqual(self.mock_handler.do_readyz.call_count, 1)
+
+        sync.WebHandler.do_readyz(self.mock_handler)
+        self.mock_handler.send_response.assert_called_with(503)
+        sync.get_fleet_index(sync.WebHandler.namespace)
+        sync.WebHandler.do_readyz(self.mock_handler)
+        self.mock_handler.send_response.assert_called_with(200)
+
+    @mock.patch.object(sync, 'datastore')
+    def test_snapshot_age_after_skipped_refresh(self, mock_datastore):
+        fetch = mock_datastore.Client().query().fetch
+        fetch.return_value = self.test_datastore_data
+        with freezegun.freeze_time('2017-03-28') as frozen_time:
+            self.assertIsNone(sync.get_snapshot_age('scraper'))
+            index = sync.get_fleet_index('scraper')
+            frozen_time.tick(datetime.timedelta(seconds=40))
+            self.assertEqual(sync.get_snapshot_age('scraper'), 40)
+            # A refresh that finds no change makes the data current again.
+            self.assertIs(sync.get_fleet_index('scraper'), index)
+            self.assertEqual(sync.get_snapshot_age('scraper'), 0)
+        self.assertEqual(self.full_fetch_count(fetch), 1)
+
+    @testfixtures.log_capture()
+    def test_warm_up(self, log):
+        sync.get_kubernetes_json.side_effect = Exception('no kubernetes')
+        with mock.patch.object(sync.time, 'sleep') as sleep:
+            with mock.patch.object(
+                sync, 'get_fleet_index',
+                side_effect=[Exception('not yet'), None]) as get_fleet_index:
+                sync.warm_up('scraper')
+        self.assertEqual(get_fleet_index.call_count, 2)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(sync.get_kubernetes_json.call_count, 1)
+        self.assertEqual(
+            len([x for x in log.records if x.levelname == 'ERROR']), 2)
+
+    @testfixtures.log_capture()
+    def test_do_get_access_log_sampling(self, log):
+        self.mock_handler.path = '/'
+        with mock.patch.object(sync.WebHandler, 'access_log_sample_rate', 0):
+            sync.WebHandler.do_GET(self.mock_handler)
+        self.assertEqual(len(log.records), 0)
+        sync.WebHandler.do_GET(self.mock_handler)
+        self.assertEqual(len(log.records), 1)
+
+    @testfixtures.log_capture()
+    def test_log_message(self, log):
+        sync.WebHandler.log_message(self.mock_handler, '"%s" %s', 'GET /', 200)
+        self.assertEqual([(x.levelname, x.getMessage()) for x in log.records],
+                         [('DEBUG', '1234 - "GET /" 200')])
+        # Formatting is left to logging.
+        self.assertEqual(log.records[0].args, (1234, 'GET /', 200))
+
+    @testfixtures.log_capture()
+    def test_log_error(self, log):
+        sync.WebHandler.log_error(self.mock_handler, 'code %d, message %s',
+                                  404, 'Not Found')
+        self.assertEqual([(x.levelname, x.getMessage()) for x in log.records],
+                         [('WARNING', '1234 - code 404, message Not Found')])
+
+    def test_queue_logging(self):
+        queue = Queue.Queue(10)
+        target = logging.handlers.BufferingHandler(10)
+        target.setLevel(logging.INFO)
+        listener = sync.QueueListener(queue, target)
+        logger = logging.getLogger('test_queue_logging')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(sync.QueueHandler(queue))
+        listener.start()
+        logger.info('info %s', 'message')
+        logger.debug('debug message')
+        try:
+            raise ValueError('oops')
+        except ValueError:
+            logger.exception('failure')
+        listener.stop()
+        self.assertEqual([x.getMessage() for x in target.buffer],
+                         ['info message', 'failure'])
+        self.assertIn('ValueError: oops', target.buffer[1].exc_text)
+        self.assertIsNone(target.buffer[1].exc_info)
+
+    def test_queue_logging_drops_when_full(self):
+        queue = Queue.Queue(1)
+        logger = logging.getLogger('test_queue_logging_drops_when_full')
+        logger.propagate = False
+        logger.addHandler(sync.QueueHandler(queue))
+        logger.error('first')
+        # If this blocked, the test would never finish.
+        logger.error('second')
+        self.assertEqual(queue.qsize(), 1)
+        self.assertEqual(queue.get().getMessage(), 'first')
+
+    def test_repeated_message_filter(self):
+        log_filter = sync.RepeatedMessageFilter(60)
+
+        def record(level, created, msg='Bad rsync url: %s', lineno=10):
+            log_record = logging.LogRecord('root', level, 'sync.py', lineno,
+                                           msg, ('rsync://bad',), None)
+            log_record.created = created
+            return log_record
+
+        self.assertTrue(log_filter.filter(record(logging.ERROR, 1000)))
+        self.assertFalse(log_filter.filter(record(logging.ERROR, 1001)))
+        self.assertFalse(log_filter.filter(record(logging.ERROR, 1059)))
+        self.assertTrue(log_filter.filter(record(logging.ERROR, 1001,
+                                                 lineno=11)))
+        self.assertTrue(log_filter.filter(record(logging.INFO, 1001)))
+        passed = record(logging.ERROR, 1060)
+        self.assertTrue(log_filter.filter(passed))
+        self.assertEqual(passed.getMessage(),
+                         'Bad rsync url: rsync://bad '
+                         '[2 similar messages suppressed]')
 
     def test_do_404_on_bad_urls(self):
         self.mock_handler.path = 'BAD'
@@ -424,6 +811,268 @@ class TestSync(unittest.TestCase):
         result = json.loads(self.mock_handler.wfile.getvalue())['result']
         self.assertEqual(len(result), 1)
 
+    def test_negotiate_format(self):
+        self.assertEqual(sync.negotiate_format('', ''), 'json')
+        self.assertEqual(sync.negotiate_format('', '*/*'), 'json')
+        self.assertEqual(sync.negotiate_format('ndjson', 'application/json'),
+                         'ndjson')
+        self.assertEqual(
+            sync.negotiate_format('', 'application/x-ndjson'), 'ndjson')
+        self.assertEqual(
+            sync.negotiate_format(
+                '', 'application/json;q=0.5, application/msgpack'),
+            'msgpack')
+        self.assertEqual(
+            sync.negotiate_format(
+                '', 'application/vnd.mlab.columnar+json, application/json'),
+            'columnar')
+        self.assertEqual(
+            sync.negotiate_format('', 'application/msgpack;q=0'), 'json')
+        with self.assertRaises(sync.SyncException):
+            sync.negotiate_format('xml', '')
+
+    def test_do_scraper_status_formats_agree(self):
+        def fetch(query_string, accept=''):
+            self.mock_handler.wfile = StringIO.StringIO()
+            sync.WebHandler.do_scraper_status(self.mock_handler, query_string,
+                                              accept)
+            return self.mock_handler.wfile.getvalue()
+
+        for query_string in ('', 'rsync_filter=prg01', 'site=none'):
+            expected = json.loads(fetch(query_string))['result']
+            self.assertEqual(
+                [json.loads(line) for line in
+                 fetch(query_string, 'application/x-ndjson').splitlines()],
+                expected)
+            self.assertEqual(
+                msgpack.unpackb(fetch(query_string + '&format=msgpack'),
+                                raw=False)['result'],
+                expected)
+            columns = json.loads(fetch(query_string + '&format=columnar'))
+            self.assertEqual(sorted(columns['result']), sorted(sync.KEYS))
+            self.assertEqual(
+                [dict((key, columns['result'][key][row]) for key in sync.KEYS)
+                 for row in range(len(expected))],
+                expected)
+        self.assertEqual(
+            self.mock_handler.send_header.call_args_list[0][0],
+            ('Content-type', 'application/json'))
+        self.assertEqual(self.mock_handler.send_response.call_count, 12)
+        self.assertEqual(
+            self.mock_handler.send_header.call_args_list.count(
+                mock.call('Vary', 'Accept')),
+            12)
+
+    def test_do_scraper_status_whole_snapshot_encoded_once(self):
+        sync.WebHandler.do_scraper_status(self.mock_handler, 'format=ndjson')
+        index = sync.get_fleet_index(sync.WebHandler.namespace)
+        body = index.encode(range(len(index.data)), 'ndjson')
+        self.assertIs(index.encode(range(len(index.data)), 'ndjson'), body)
+        self.assertEqual(self.mock_handler.wfile.getvalue(), body)
+
+    def test_do_scraper_status_bad_format(self):
+        sync.WebHandler.do_scraper_status(self.mock_handler, 'format=xml')
+        self.assertEqual(self.mock_handler.send_error.call_args[0][0], 400)
+
+    def test_parse_duration(self):
+        self.assertEqual(sync.parse_duration('90'), 90)
+        self.assertEqual(sync.parse_duration('90s'), 90)
+        self.assertEqual(sync.parse_duration('30m'), 1800)
+        self.assertEqual(sync.parse_duration('6h'), 21600)
+        self.assertEqual(sync.parse_duration('2d'), 172800)
+        self.assertIsNone(sync.parse_duration(''))
+        self.assertIsNone(sync.parse_duration('6 hours'))
+        self.assertIsNone(sync.parse_duration('-5'))
+
+    def test_parse_status_query(self):
+        query = sync.parse_status_query(
+            'rsync_filter=mlab4&site=prg01&site=sea02&stale_after=6h')
+        self.assertEqual(query.rsync_filter, 'mlab4')
+        self.assertEqual(query.criteria, {'site': ['prg01', 'sea02']})
+        self.assertEqual(query.stale_after, 21600)
+        self.assertIsNone(query.fresh_within)
+        with self.assertRaises(sync.SyncException):
+            sync.parse_status_query('fresh_within=soon')
+
+    def test_fleet_index_select(self):
+        index = sync.FleetIndex(sync.get_fleet_data('scraper'))
+        urls = lambda entries: set(x['dropboxrsyncaddress'] for x in entries)
+        self.assertEqual(len(index.select({})), 3)
+        self.assertEqual(
+            urls(index.select({'site': ['sea02']})),
+            set(['rsync://utility.mlab.mlab4.sea02.measurement-lab.org:7999/'
+                 'switch']))
+        self.assertEqual(len(index.select({'rsync_module': ['switch']})), 2)
+        self.assertEqual(
+            len(index.select({'rsync_module': ['switch'],
+                              'machine': ['mlab4.prg01.measurement-lab.org']})),
+            1)
+        self.assertEqual(index.select({'experiment': ['ndt']}), [])
+
+        # Midnight plus six hours on the day of the last successful collection.
+        now = sync.parse_xdatetime('x2017-03-28 06:00')
+        self.assertEqual(len(index.select({}, stale_after=3600, now=now)), 3)
+        self.assertEqual(
+            urls(index.select({}, stale_after=12 * 3600, now=now)),
+            set(['rsync://utility.mlab.mlab4.sea02.measurement-lab.org:7999/'
+                 'switch']))
+        self.assertEqual(
+            len(index.select({}, fresh_within=12 * 3600, now=now)), 2)
+        self.assertEqual(
+            index.select({}, stale_after=3600, fresh_within=7200, now=now), [])
+        self.assertEqual(
+            len(index.select({'site': ['prg01']}, stale_after=3600, now=now)),
+            2)
+
+    def test_get_fleet_index_rebuilt_once_per_snapshot(self):
+        index = sync.get_fleet_index('scraper')
+        self.assertIs(sync.get_fleet_index('scraper'), index)
+        # The cache expired, but the data in datastore has not changed.
+        sync.get_fleet_data.clear_cache()
+        self.assertIs(sync.get_fleet_index('scraper'), index)
+        sync.get_fleet_data.clear_cache()
+        sync.get_fleet_data.clear_snapshots()
+        self.assertIsNot(sync.get_fleet_index('scraper'), index)
+
+    def test_do_scraper_status_structured(self):
+        with freezegun.freeze_time('2017-03-28 06:00:00'):
+            sync.WebHandler.do_scraper_status(
+                self.mock_handler, 'site=prg01&site=sea02&stale_after=12h')
+        result = json.loads(self.mock_handler.wfile.getvalue())['result']
+        self.assertEqual([x['dropboxrsyncaddress'] for x in result],
+                         ['rsync://utility.mlab.mlab4.sea02.measurement-lab.org'
+                          ':7999/switch'])
+
+    def test_do_scraper_status_bad_duration(self):
+        sync.WebHandler.do_scraper_status(self.mock_handler,
+                                          'stale_after=yesterday')
+        self.assertEqual(self.mock_handler.send_error.call_args[0][0], 400)
+        self.assertEqual(self.mock_handler.send_response.call_count, 0)
+        self.assertEqual(self.mock_handler.wfile.getvalue(), '')
+
+
+class TestDebugMetricsHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_handler = mock.Mock(sync.DebugMetricsHandler)
+        self.mock_handler.wfile = StringIO.StringIO()
+        self.mock_handler.send_json.side_effect = (
+            lambda value: sync.DebugMetricsHandler.send_json(self.mock_handler,
+                                                             value))
+        enabled_patcher = mock.patch.object(sync.DebugMetricsHandler,
+                                            'debug_enabled', True)
+        enabled_patcher.start()
+        self.addCleanup(enabled_patcher.stop)
+        baseline_patcher = mock.patch.object(sync.DebugMetricsHandler,
+                                             'memory_baseline', None)
+        baseline_patcher.start()
+        self.addCleanup(baseline_patcher.stop)
+        sync.get_fleet_data.clear_cache()
+        sync.get_fleet_data.clear_snapshots()
+        sync.get_fleet_index.clear_cache()
+
+    def get(self, path):
+        self.mock_handler.path = path
+        sync.DebugMetricsHandler.do_GET(self.mock_handler)
+
+    def test_metrics_still_served(self):
+        with mock.patch.object(sync.prometheus_client.MetricsHandler,
+                               'do_GET') as metrics_do_get:
+            self.get('/metrics')
+            self.assertEqual(metrics_do_get.call_count, 1)
+            with mock.patch.object(sync.DebugMetricsHandler, 'debug_enabled',
+                                   False):
+                self.get('/debug/memory')
+            self.assertEqual(metrics_do_get.call_count, 2)
+            self.assertEqual(self.mock_handler.do_memory.call_count, 0)
+
+    def test_routing(self):
+        self.get('/debug/profile?seconds=5')
+        self.mock_handler.do_profile.assert_called_once_with('seconds=5')
+        self.get('/debug/memory')
+        self.assertEqual(self.mock_handler.do_memory.call_count, 1)
+        self.get('/debug/memory/diff')
+        self.assertEqual(self.mock_handler.do_memory_diff.call_count, 1)
+        self.get('/debug/nothing')
+        self.mock_handler.send_error.assert_called_once_with(404)
+
+    def test_do_profile(self):
+        stop = threading.Event()
+
+        def busy_function_to_find():
+            while not stop.is_set():
+                time.sleep(0.001)
+
+        thread = threading.Thread(target=busy_function_to_find)
+        thread.start()
+        try:
+            sync.DebugMetricsHandler.do_profile(self.mock_handler,
+                                                'seconds=0.1')
+        finally:
+            stop.set()
+            thread.join()
+        self.mock_handler.send_response.assert_called_once_with(200)
+        self.assertIn('sync_test.py:busy_function_to_find',
+                      self.mock_handler.wfile.getvalue())
+
+    def test_do_profile_idle_threads(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait)
+        thread.start()
+        try:
+            idle = sync.sample_stacks(0.05, include_idle=True)
+            busy = sync.sample_stacks(0.05)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertTrue(any(x.endswith('threading.py:wait') for x in idle))
+        self.assertFalse(any(x.endswith('threading.py:wait') for x in busy))
+
+    def test_do_profile_bad_requests(self):
+        for query_string in ('seconds=0', 'seconds=61', 'seconds=soon'):
+            sync.DebugMetricsHandler.do_profile(self.mock_handler,
+                                                query_string)
+            self.assertEqual(self.mock_handler.send_error.call_args[0][0], 400)
+        with sync.DebugMetricsHandler.profile_lock:
+            sync.DebugMetricsHandler.do_profile(self.mock_handler, '')
+        self.assertEqual(self.mock_handler.send_error.call_args[0][0], 409)
+        self.assertEqual(self.mock_handler.send_response.call_count, 0)
+
+    def test_do_memory_and_diff(self):
+        sync.DebugMetricsHandler.do_memory_diff(self.mock_handler)
+        self.assertEqual(self.mock_handler.send_error.call_args[0][0], 409)
+
+        sync.DebugMetricsHandler.do_memory(self.mock_handler)
+        memory = json.loads(self.mock_handler.wfile.getvalue())
+        self.assertGreater(memory['max_rss_kilobytes'], 0)
+        self.assertIn('dict', [name for name, _ in memory['top_types']])
+
+        self.mock_handler.wfile = StringIO.StringIO()
+        allocated = [TestSync.FakeEntity('x', {}) for _ in range(1000)]
+        sync.DebugMetricsHandler.do_memory_diff(self.mock_handler)
+        changes = json.loads(self.mock_handler.wfile.getvalue())['changes']
+        changes = dict(changes)
+        self.assertGreaterEqual(changes['FakeEntity'], len(allocated))
+
+    def test_do_snapshot(self):
+        sync.get_fleet_index('scraper')
+        self.get('/debug/snapshot')
+        description = json.loads(self.mock_handler.wfile.getvalue())
+        self.assertEqual(description['fleet_data']['scraper']['entries'], 3)
+        self.assertGreater(
+            description['fleet_data']['scraper']['approximate_bytes'], 0)
+        self.assertEqual(
+            sorted(description['fleet_indexes']['scraper']),
+            ['encoded_bodies_bytes', 'encoded_rows_bytes', 'indexes_bytes'])
+        self.assertEqual(
+            description['cached_results']['get_fleet_data'], 1)
+
+    def test_approximate_size(self):
+        text = 'x' * 1000
+        self.assertGreater(sync.approximate_size([text]), 1000)
+        self.assertLess(sync.approximate_size([text, text]), 2000)
+        self.assertGreater(sync.approximate_size({'key': [text]}), 1000)
+
 
 if __name__ == '__main__':  # pragma: no cover
     unittest.main()